@@ -0,0 +1,219 @@
+""" Backtesting.py
+
+Rolling-origin backtests of the seasonality profiles and the post-campaign linear susceptibility
+forecasts from ForecastTesting.py, for every country at every monthly training cutoff. """
+
+import os
+import time as timer
+
+## Standard imports
+import numpy as np
+import pandas as pd
+
+## For spreading countries across cores
+from concurrent.futures import ProcessPoolExecutor
+
+## Data processing
+from Profiles import BatchedProfileRegression, ProfileStatistics
+from utils import process_case_data,\
+                  process_sia_calendar,\
+                  sia_dose_covariate
+
+## Susceptibility inference
+from RelativeSusceptibility import demographic_pressure,\
+                                   relative_susceptibility
+
+def prefix_statistics(ln_cr, cutoffs):
+    """ Profile regression statistics for every (cutoff, country) pair, computed from cumulative
+    sums over the wide table of monthly log case ratios, so that each cutoff's statistics
+    cover the rows with time <= cutoff. NaNs are treated as unobserved, and cutoffs before the
+    first row get empty statistics. """
+
+    ## Per-row contributions to each calendar month's statistics
+    y = ln_cr.values
+    observed = np.isfinite(y)
+    y = np.where(observed, y, 0.)
+    month = ln_cr.index.month.values - 1
+    rows = np.arange(len(y))
+    stats = np.zeros((3, len(y), 12, y.shape[1]))
+    stats[0, rows, month] = observed
+    stats[1, rows, month] = y
+    stats[2, rows, month] = y**2
+
+    ## Accumulate, with a leading row of zeros for the empty
+    ## prefix, and take the prefix at each cutoff
+    stats = np.cumsum(np.concatenate([np.zeros_like(stats[:, :1]), stats], axis=1), axis=1)
+    stats = stats[:, ln_cr.index.searchsorted(cutoffs, side="right")]
+
+    ## Stack (cutoff, country) pairs as the units
+    counts, sums, sumsq = stats.transpose(0, 2, 1, 3).reshape(3, 12, -1)
+    units = pd.MultiIndex.from_product([cutoffs, ln_cr.columns], names=["cutoff", "Country"])
+    return ProfileStatistics(units, counts, sums, sumsq)
+
+def backtest_country(country, cases, vax, ln_cr, mu_hat, p_low, alphas, cutoffs,
+                     start_date="2014-01-01", extrap_months=36):
+    """ Susceptibility reconstructions and linear forecasts for a single country over a set of
+    cutoffs, given the profile fit (mu_hat, p_low, shape (12, num_cutoffs)) and demographic
+    pressure (alphas, shape (num_cutoffs, 2)) at each cutoff. cases, vax, and ln_cr are monthly
+    series over the full record.
+
+    Forecasts of Z_t are scored against the observed excess growth, exp(residual) - 1, which is
+    what the volatility rescaling in relative_susceptibility regresses Z_t against. """
+
+    month = ln_cr.index.month.values - 1
+    cases = cases.loc[start_date:]
+    vax = vax.reindex(cases.index).fillna(0)
+    output = []
+    for k, cutoff in enumerate(cutoffs):
+
+        ## Skip cutoffs without a profile fit
+        if np.isnan(mu_hat[:, k]).any():
+            continue
+
+        ## Training window, skipping cutoffs without enough
+        ## months after start_date
+        tcases = cases.loc[:cutoff]
+        if len(tcases) < 2:
+            continue
+        tvax = vax.loc[:tcases.index[-1]]
+        residuals = pd.Series(ln_cr.values - mu_hat[month, k], index=ln_cr.index)
+        try:
+            success, thetas, vol_scale, Zt, Zterr = relative_susceptibility(
+                    alphas[k],
+                    tcases,
+                    tvax,
+                    residuals.loc[tcases.index[0]:tcases.index[-2]]
+                    )
+        except (np.linalg.LinAlgError, ValueError):
+            continue
+
+        ## Make the forecast, as in ForecastTesting.py
+        ex_time = cases.loc[tcases.index[-1]:].index[:extrap_months]
+        Zt_extrap = Zt[-1] + np.arange(len(ex_time)) * alphas[k, 1] * vol_scale
+        if len(thetas) > 1:
+            Zt_extrap += -vol_scale * np.cumsum(vax.loc[ex_time].values) * thetas[1]
+
+        ## Compare to the observed growth, dropping the cutoff itself
+        ex_month = ex_time.month.values - 1
+        ex_residual = residuals.reindex(ex_time).values
+        output.append(pd.DataFrame({"Country": country,
+                                    "cutoff": cutoff,
+                                    "horizon": np.arange(len(ex_time)),
+                                    "time": ex_time,
+                                    "success": success,
+                                    "vol_scale": vol_scale,
+                                    "p_high": 1. - p_low[ex_month, k],
+                                    "Zt_forecast": Zt_extrap,
+                                    "Zt_err": Zterr[-1],
+                                    "excess": np.exp(ex_residual) - 1.,
+                                    }).iloc[1:])
+
+    if not output:
+        return None
+    output = pd.concat(output, axis=0, ignore_index=True)
+    output["error"] = output["Zt_forecast"] - output["excess"]
+    return output
+
+def _backtest_country(args):
+    return backtest_country(*args[:-1], **args[-1])
+
+def Backtest(data, sia_cal, cutoffs,
+             start_date="2014-01-01",
+             extrap_months=36,
+             min_months=36,
+             max_workers=None):
+
+    """ Backtest every country in data (the long frame from utils.process_case_data) at every
+    cutoff. The profile fits for all (cutoff, country) pairs come from prefix statistics in a
+    single batched solve, and the per-country susceptibility work is spread over a process
+    pool. min_months is the minimum number of observed months needed for a profile fit.
+    Returns one tidy frame with a row per (country, cutoff, forecast month), which is empty
+    if no cutoff could be scored. """
+
+    ## Wide monthly series
+    cases = data.pivot(index="time", columns="Country", values="Cases")
+    Cm_1 = data.pivot(index="time", columns="Country", values="cases_next_month")
+    ln_cr = 0.5 * (np.log(Cm_1 + 1) - np.log(cases + 1))
+    cutoffs = pd.DatetimeIndex(cutoffs)
+
+    ## Fit the profiles at every cutoff together, with enough data
+    stats = prefix_statistics(ln_cr, cutoffs)
+    fit = stats.counts.sum(axis=0) >= min_months
+    profiles = BatchedProfileRegression(stats.subset(stats.countries[fit]))
+    pressure = demographic_pressure(profiles, 1).reindex(stats.countries)
+
+    ## Reshape to (12, num_cutoffs, num_countries) for the workers
+    shape = (12, len(cutoffs), len(ln_cr.columns))
+    mu_hat = np.full((12, len(stats.countries)), np.nan)
+    p_low = np.full((12, len(stats.countries)), np.nan)
+    mu_hat[:, fit] = profiles.mu_hat
+    p_low[:, fit] = profiles.p_low
+    mu_hat = mu_hat.reshape(shape)
+    p_low = p_low.reshape(shape)
+    alphas = pressure.values.reshape(len(cutoffs), len(ln_cr.columns), 2)
+
+    ## Monthly SIA doses (in millions), aligned with the case data
+    vax = sia_dose_covariate(sia_cal, cases.index, cases.columns)
+
+    ## Loop over countries in parallel
+    jobs = []
+    for i, country in enumerate(ln_cr.columns):
+        jobs.append((country,
+                     cases[country].dropna(),
+                     vax[country],
+                     ln_cr[country],
+                     mu_hat[:, :, i],
+                     p_low[:, :, i],
+                     alphas[:, i],
+                     cutoffs,
+                     {"start_date": start_date, "extrap_months": extrap_months}))
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        results = list(executor.map(_backtest_country, jobs, chunksize=4))
+    results = [r for r in results if r is not None]
+    if not results:
+        return pd.DataFrame(columns=["Country", "cutoff", "horizon", "time", "success",
+                                     "vol_scale", "p_high", "Zt_forecast", "Zt_err",
+                                     "excess", "error"])
+    return pd.concat(results, axis=0, ignore_index=True)
+
+if __name__ == "__main__":
+
+    ## Backtest set up
+    start_date = "2014-01-01"
+    end_date = "2024-01-01"
+    cutoffs = pd.date_range("2017-01-01", "2022-12-01", freq="MS") + pd.to_timedelta(14, unit="d")
+    extrap_months = 36
+
+    ## Get the data for every country in the WHO file
+    fname = os.path.join("data", "measlescasesbycountrybymonth_Mar2024.csv")
+    countries_list = pd.read_csv(fname, usecols=["Country"])["Country"].unique()
+    data = process_case_data(
+        fname,
+        long_return=True,
+        countries_list=countries_list,
+    )
+    data = data.loc[data["time"] <= end_date]
+    sia_cal = process_sia_calendar(os.path.join("data", "Summary_MR_SIA.csv"))
+
+    ## Run the backtest
+    tic = timer.time()
+    skill = Backtest(data, sia_cal, cutoffs,
+                     start_date=start_date,
+                     extrap_months=extrap_months)
+    print("\nBacktest took {:.1f} seconds".format(timer.time() - tic))
+    print(skill)
+
+    ## Summarize forecast skill by country, relative to the
+    ## profile alone (i.e. Z_t = 0).
+    scored = skill.dropna(subset=["error"])
+    summary = pd.DataFrame({
+        "rmse": np.sqrt((scored["error"]**2).groupby(scored["Country"]).mean()),
+        "rmse_profile": np.sqrt((scored["excess"]**2).groupby(scored["Country"]).mean()),
+        "num_forecasts": scored.groupby("Country").size(),
+        })
+    summary["skill"] = 1. - (summary["rmse"] / summary["rmse_profile"])**2
+    print("\nForecast skill by country:")
+    print(summary.sort_values("skill", ascending=False))
+
+    ## Serialize the tidy table
+    skill.to_csv(os.path.join("outputs", "backtest_skill.csv"), index=False)
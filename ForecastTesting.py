@@ -13,6 +13,7 @@ import matplotlib.pyplot as plt
 from Profiles import ProfileRegression
 from utils import process_case_data,\
                   process_sia_calendar,\
+                  sia_dose_covariate,\
                   axes_setup
 from collections import defaultdict
 
@@ -105,17 +106,7 @@ if __name__ == "__main__":
     cases = cases.loc[start_date:]
 
     ## And vax
-    cal = sia_cal.loc[sia_cal["Country"] == countries_list[0]]
-    vax = cal[["time","doses"]]\
-            .dropna()\
-            .sort_values("time")\
-            .set_index("time")["doses"]
-    vax = pd.DataFrame(np.diag(vax.values),
-                    index=vax.index,columns=vax.index)
-    vax = vax.resample("MS").sum()
-    vax.index = vax.index + pd.to_timedelta(14,unit="d")
-    vax = vax.reindex(cases.index)\
-            .fillna(0).sum(axis=1)/1.e6
+    vax = sia_dose_covariate(sia_cal,cases.index,countries_list)[countries_list[0]]
     tvax = vax.loc[:tcases.index[-1]].copy()
 
     ## Compute demographic pressure parameters via
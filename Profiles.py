@@ -12,35 +12,69 @@ import numpy as np
 import pandas as pd
 
 ## For the log normal cdf, quantiles
-from scipy.special import erf, erfinv
+from scipy.special import erf, erfinv, gammaln
 
 ## Data processing
 from utils import process_case_data
 
+## Batched cyclic banded solvers
+from banded import CyclicBandedCholesky, cyclic_matvec, rw2_eigenvalues
+
+def period_index(time, periodicity=12):
+    """ Position of each time stamp within the year, on a grid of P = periodicity periods.
+    Monthly (12) and semi-monthly (24) periods follow the calendar, with the 15th as the end
+    of the first half month, and other periods (52 for weeks, 365 for days, etc.) split
+    the year evenly by day of year. """
+    time = pd.DatetimeIndex(time)
+    if periodicity == 12:
+        return time.month.values - 1
+    elif periodicity == 24:
+        return 2 * (time.month.values - 1) + (time.day.values > 15)
+    days = 365. + time.is_leap_year
+    return np.floor(periodicity * (time.dayofyear.values - 1) / days).astype(int)
+
+def trig_interpolant(t, periodicity=12):
+    """ Design matrix for periodic (trigonometric) interpolation of a profile sampled at
+    periods 1, 2, ..., P onto the times t, in the same units. """
+    tk = np.arange(1., periodicity + 1.)
+    dt = (t[:,None]-tk[None,:])
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        if periodicity % 2 == 0:
+            X_int = np.sin(np.pi*dt)/(periodicity*np.tan(np.pi*dt/periodicity))
+        else:
+            X_int = np.sin(np.pi*dt)/(periodicity*np.sin(np.pi*dt/periodicity))
+    return np.nan_to_num(X_int,nan=1.)
+
 class ProfileRegression:
-    def __init__(self, tr_data):
+    def __init__(self, tr_data, prior_scale=(2.**4) / 4.0, periodicity=12):
         self.tr_data = tr_data
 
         ## Make two data frames by country, one for cases today, one
-        ## for datas next month
-        Cm = tr_data.pivot(index="time", columns="Country", values="Cases")
-        Cm_1 = tr_data.pivot(index="time", columns="Country", values="cases_next_month")
-        ln_cr = 0.5 * (np.log(Cm_1 + 1) - np.log(Cm + 1))
+        ## for datas next month, unless we're given the wide log case
+        ## ratios already (i.e. from utils.process_case_array).
+        if "cases_next_month" in tr_data.columns:
+            Cm = tr_data.pivot(index="time", columns="Country", values="Cases")
+            Cm_1 = tr_data.pivot(index="time", columns="Country", values="cases_next_month")
+            ln_cr = 0.5 * (np.log(Cm_1 + 1) - np.log(Cm + 1))
+        else:
+            ln_cr = tr_data
         self.ln_cr = ln_cr
+        self.countries = ln_cr.columns
 
         ## Make the linear regression operator
         ## Start with the periodic percision matrix
         ## for the prior distribution.
         D2 = (
-            np.diag(12 * [-2])
-            + np.diag((12 - 1) * [1], k=1)
-            + np.diag((12 - 1) * [1], k=-1)
+            np.diag(periodicity * [-2])
+            + np.diag((periodicity - 1) * [1], k=1)
+            + np.diag((periodicity - 1) * [1], k=-1)
         )
         D2[0, -1] = 1  ## Periodic BCs
         D2[-1, 0] = 1
         pRW2 = np.dot(D2.T, D2) * (
-            (2.**4) / 4.0
-        )  ## From the total variation of a sine function
+            prior_scale
+        )  ## Default from the total variation of a sine function
         self.pRW2 = pRW2
 
         ## Then construction the operator mapping beta's to time
@@ -74,10 +108,566 @@ class ProfileRegression:
         p_low = 0.5 * (1 + erf((-self.mu_hat) / (self.sigs * np.sqrt(2))))
         self.p_low = p_low
 
-    def periodic_pad(self,a,length=13):
+    def periodic_pad(self,a,length=None):
+        if length is None:
+            length = a.shape[0] + 1
         repeats = int((length/a.shape[0]) + 1)
         return np.vstack(repeats*[a])[:length,:]
 
+class ProfileStatistics:
+
+    """ Sufficient statistics for the profile regression: per period (calendar month by default)
+    counts, sums, and sums of squares of the log case ratios for each country, all with shape
+    (periodicity, num_countries). Statistics from different data shards can be merged with +. """
+
+    def __init__(self, countries, counts, sums, sumsq):
+        self.countries = countries
+        if not isinstance(countries, pd.MultiIndex):
+            self.countries = pd.Index(countries, name="Country")
+        self.counts = counts
+        self.sums = sums
+        self.sumsq = sumsq
+        self.periodicity = counts.shape[0]
+
+    @classmethod
+    def from_frame(cls, tr_data, periodicity=12):
+        """ Accumulate the statistics in a single pass over the long frame from
+        utils.process_case_data. """
+        ln_cr = 0.5 * (np.log(tr_data["cases_next_month"].values + 1)
+                       - np.log(tr_data["Cases"].values + 1))
+        return cls.from_values(tr_data["Country"].values, tr_data["time"].values, ln_cr,
+                               periodicity=periodicity)
+
+    @classmethod
+    def from_values(cls, country, time, ln_cr, weights=None, periodicity=12):
+        """ Accumulate the statistics from row-wise arrays of countries, times, and log case
+        ratios. weights scale each row's contribution, so weights of -1 retract rows
+        that were previously accumulated. Non-finite log case ratios (from negative case
+        counts, for example) are skipped. """
+
+        ## Flat (period, country) bins
+        codes, countries = pd.factorize(country, sort=True)
+        period = period_index(time, periodicity)
+        bins = period * len(countries) + codes
+        size = periodicity * len(countries)
+        if weights is None:
+            weights = np.ones(len(ln_cr))
+        observed = np.isfinite(ln_cr)
+        weights = np.where(observed, weights, 0.)
+        ln_cr = np.where(observed, ln_cr, 0.)
+
+        ## And accumulate
+        shape = (periodicity, len(countries))
+        counts = np.bincount(bins, weights=weights, minlength=size).reshape(shape)
+        sums = np.bincount(bins, weights=weights * ln_cr, minlength=size).reshape(shape)
+        sumsq = np.bincount(bins, weights=weights * ln_cr**2, minlength=size).reshape(shape)
+        return cls(countries, counts, sums, sumsq)
+
+    @classmethod
+    def from_wide(cls, ln_cr, periodicity=12):
+        """ Accumulate the statistics from a wide (time by country) frame of log case ratios,
+        treating NaNs (late reporting starts, gaps, countries dropped from the file) as
+        missing, so that each country contributes only its observed months. """
+        y = ln_cr.values
+        observed = np.isfinite(y)
+        y = np.where(observed, y, 0.)
+        period = period_index(ln_cr.index, periodicity)
+        onehot = (period[None, :] == np.arange(periodicity)[:, None]).astype(np.float64)
+        return cls(ln_cr.columns, onehot @ observed, onehot @ y, onehot @ y**2)
+
+    def __add__(self, other):
+        countries = self.countries.union(other.countries)
+        if self.periodicity != other.periodicity:
+            raise ValueError("Can't merge statistics with different periodicities.")
+        stats = [np.zeros((3, self.periodicity, len(countries))) for _ in range(2)]
+        for s, shard in zip(stats, (self, other)):
+            s[:, :, countries.get_indexer(shard.countries)] = [shard.counts, shard.sums, shard.sumsq]
+        counts, sums, sumsq = stats[0] + stats[1]
+        return ProfileStatistics(countries, counts, sums, sumsq)
+
+    def subset(self, countries):
+        """ Statistics for a subset of the countries. """
+        i = self.countries.get_indexer(countries)
+        return ProfileStatistics(self.countries[i], self.counts[:, i], self.sums[:, i], self.sumsq[:, i])
+
+class BatchedProfileRegression:
+
+    """ The ProfileRegression estimates for many countries (or subnational units) at once. The
+    stacked identity operator X is never formed: X.T @ X is a diagonal of per-period counts
+    and X.T @ ln_cr is a per-period sum, so each unit's system is the cyclic pentadiagonal
+    RW2 precision plus a diagonal, which we factor with a batched banded Cholesky. Cost and
+    memory are linear in the number of units and in the number of periods, P = periodicity
+    (12 for monthly data, 24 for semi-monthly, 52 for weekly, see period_index), so long
+    periods like P = 365 are practical. Full covariance matrices are only computed on
+    request, via cov().
+
+    tr_data is either the long frame from utils.process_case_data, a wide (time by country)
+    frame of log case ratios, or a ProfileStatistics object. In the last case the fit needs
+    only the statistics, and ln_cr and residuals() are unavailable. Missing or non-finite log
+    case ratios are masked, so each unit uses only its observed months, and ragged histories
+    don't need to be trimmed to a common window. Units with no data are NaN throughout.
+    prior_scale is the RW2 prior strength, either a scalar or one value per unit (see
+    select_prior_scale). """
+
+    def __init__(self, tr_data, prior_scale=(2.**4) / 4.0, periodicity=12):
+        self.tr_data = tr_data
+        self.prior_scale = prior_scale
+        self.ln_cr = None
+        if isinstance(tr_data, ProfileStatistics):
+            self.stats = tr_data
+        else:
+            if "cases_next_month" in tr_data.columns:
+                ## Wide log case ratios, as in ProfileRegression
+                Cm = tr_data.pivot(index="time", columns="Country", values="Cases")
+                Cm_1 = tr_data.pivot(index="time", columns="Country", values="cases_next_month")
+                ln_cr = 0.5 * (np.log(Cm_1 + 1) - np.log(Cm + 1))
+            else:
+                ln_cr = tr_data
+            self.ln_cr = ln_cr
+
+            ## Period (calendar month by default) of each row, which is what the
+            ## row-wise alignment in ProfileRegression amounts to for series
+            ## starting at the beginning of the year.
+            self.period = period_index(ln_cr.index, periodicity)
+            self.stats = ProfileStatistics.from_wide(ln_cr, periodicity)
+
+        ## Log case ratios folded into the statistics so far, so that revisions can be
+        ## retracted in update(). The wide frame from construction is kept as is, and only
+        ## the rows folded in since are keyed by (Country, time).
+        self.history = self.ln_cr
+        self.observed = {}
+        self.countries = self.stats.countries
+        self._fit(self.stats.counts, self.stats.sums, self.stats.sumsq)
+
+    def update(self, new_rows):
+        """ Fold new months, or revisions of months already in the fit, into the estimates.
+        new_rows has the format of the long frame from utils.process_case_data, and rows are
+        keyed on (Country, time), with a repeated key replacing the earlier value. Since
+        a revised month's cases enter two case ratios, the rows for both months should be
+        passed. The cost is O(rows + countries), independent of the length of the history.
+
+        ln_cr describes the data at construction, so it's cleared here. Fits from a
+        ProfileStatistics object have no record of past rows, and treat every row as new. """
+
+        ## Log case ratios for the new rows
+        new_rows = new_rows.dropna(subset=["cases_next_month"])\
+                           .drop_duplicates(subset=["Country", "time"], keep="last")
+        country = new_rows["Country"].values
+        time = pd.DatetimeIndex(new_rows["time"])
+        ln_cr = 0.5 * (np.log(new_rows["cases_next_month"].values + 1)
+                       - np.log(new_rows["Cases"].values + 1))
+
+        ## Find the revisions and their previous values
+        keys = list(zip(country, time))
+        old = self.previous_values(country, time)
+        revised = np.isfinite(old)
+
+        ## Retract the old values, add the new ones, and refit
+        periodicity = self.stats.periodicity
+        delta = ProfileStatistics.from_values(country, time, ln_cr, periodicity=periodicity) + \
+                ProfileStatistics.from_values(country[revised], time[revised], old[revised],
+                                              weights=-np.ones(revised.sum()),
+                                              periodicity=periodicity)
+        self.stats = self.stats + delta
+        self.observed.update(zip(keys, ln_cr))
+        self.ln_cr = None
+        self.countries = self.stats.countries
+        self._fit(self.stats.counts, self.stats.sums, self.stats.sumsq)
+        return self
+
+    def previous_values(self, country, time):
+        """ The log case ratios already in the fit for arrays of (country, time) keys, with NaN
+        for keys that aren't. Rows folded in by update() take precedence over the history from
+        construction, which is looked up by position, in O(rows). """
+        old = np.full(len(country), np.nan)
+        if self.history is not None:
+            i = self.history.index.get_indexer(time)
+            j = self.history.columns.get_indexer(country)
+            found = (i >= 0) & (j >= 0)
+            old[found] = self.history.values[i[found], j[found]]
+        if self.observed:
+            for n, k in enumerate(zip(country, time)):
+                if k in self.observed:
+                    old[n] = self.observed[k]
+        return old
+
+    def _fit(self, counts, sums, sumsq):
+
+        ## The RW2 prior precision by diagonals. D2.T @ D2 has the
+        ## stencil (1, -4, 6, -4, 1), scaled as in ProfileRegression.
+        scale = np.asarray(self.prior_scale, dtype=np.float64).reshape(-1)[None, :]
+        self.prior = (6. * scale, -4. * scale, scale)
+        self.precision = (counts + self.prior[0],
+                          self.prior[1] * np.ones_like(counts),
+                          self.prior[2] * np.ones_like(counts))
+
+        ## With the same count in every period, X.T @ X + pRW2 is circulant
+        ## and the FFT diagonalizes it. The remaining units are solved with the
+        ## banded Cholesky factorization, and units without data are skipped.
+        self.mu_hat = np.full(counts.shape, np.nan)
+        diag_inv = np.full(counts.shape, np.nan)
+        has_data = counts.sum(axis=0) > 0
+        balanced = (counts == counts[:1]).all(axis=0) & has_data
+        if balanced.any():
+            self.mu_hat[:, balanced], diag_inv[:, balanced] = circulant_solve(
+                counts[0, balanced], (scale * np.ones(counts.shape[1]))[0, balanced], sums[:, balanced])
+        banded = has_data & ~balanced
+        if banded.any():
+            chol = CyclicBandedCholesky(*[d[:, banded] for d in self.precision])
+            self.mu_hat[:, banded] = chol.solve(sums[:, banded])
+            diag_inv[:, banded] = chol.diag_inverse()
+
+        ## Residual and prior sums of squares, from the sufficient statistics
+        RSS = (sumsq - 2. * self.mu_hat * sums + counts * self.mu_hat**2).sum(axis=0)
+        prior_hat = (self.mu_hat * cyclic_matvec(*self.prior, self.mu_hat)).sum(axis=0)
+        self.var = (RSS + prior_hat) / (counts.sum(axis=0) + len(self.mu_hat) - 3)
+
+        ## Standard errors from the diagonal of the inverse alone
+        self.sigs = np.sqrt(diag_inv * self.var)
+
+        ## Compute the mean and std errors in the effective R
+        self.reff = np.exp(self.mu_hat + (self.sigs**2) / 2.0)
+        self.reff_err = np.sqrt((np.exp(self.sigs**2) - 1.0)) * self.reff
+        self.reff_low = np.exp(self.mu_hat + np.sqrt(2) * self.sigs * erfinv(2 * 0.1 - 1.0))
+        self.reff_high = np.exp(self.mu_hat + np.sqrt(2) * self.sigs * erfinv(2 * 0.9 - 1.0))
+
+        ## Compute the low season probabilities
+        self.p_low = 0.5 * (1 + erf((-self.mu_hat) / (self.sigs * np.sqrt(2))))
+
+    def cov(self, i):
+        """ The full covariance matrix for unit i, i.e. ProfileRegression.covs[i]. """
+        chol = CyclicBandedCholesky(*[d[:, i] for d in self.precision])
+        return self.var[i] * chol.inverse()
+
+    def sample(self, num_samples, chunk_size=1000, seed=None):
+        """ Draws of the full profile for every unit from the Student-t posterior,
+        mu ~ t_dof(mu_hat, var * inv(A)) with dof = T + P - 3, yielded in chunks of shape
+        (P, num_units, <= chunk_size) so memory is bounded by the chunk size, not num_samples.
+
+        With A = L @ L.T, x = inv(L.T) @ z for z ~ N(0, I) has covariance inv(A), so each chunk is
+        a single batched banded back substitution, scaled by the usual chi-squared mixing. Units
+        without data are NaN. """
+
+        rng = np.random.default_rng(seed)
+        P, U = self.mu_hat.shape
+        has_data = self.stats.counts.sum(axis=0) > 0
+        dof = (self.stats.counts.sum(axis=0) + P - 3)[has_data]
+        chol = CyclicBandedCholesky(*[d[:, has_data] for d in self.precision])
+        scale = np.sqrt(self.var[has_data])[:, None]
+        for start in range(0, num_samples, chunk_size):
+            n = min(chunk_size, num_samples - start)
+            z = rng.standard_normal((P, has_data.sum(), n))
+            w = np.sqrt(dof[:, None] / rng.chisquare(dof[:, None], size=(len(dof), n)))
+            draws = np.full((P, U, n), np.nan)
+            draws[:, has_data] = self.mu_hat[:, has_data, None] + scale * w * chol.solve_upper(z)
+            yield draws
+
+    def season_statistics(self, num_samples=10000, run_length=3, threshold=0.,
+                          chunk_size=1000, seed=None):
+        """ Joint season classifications from posterior draws of the profiles (see sample()),
+        accumulated chunk by chunk. A period is high season in a draw if its log R_eff exceeds
+        threshold, and runs of high season periods wrap around the end of the year.
+
+        Returns a frame, indexed by unit, with the probability of at least run_length consecutive
+        high season periods, and the expected number of high season periods and longest high season
+        run; and a frame, indexed by period, with the probability that each period is high season
+        and that it's the peak of the profile, with columns (statistic, unit). """
+
+        P, U = self.mu_hat.shape
+        p_run = np.zeros(U)
+        num_high = np.zeros(U)
+        longest = np.zeros(U)
+        p_high = np.zeros((P, U))
+        p_peak = np.zeros((P, U))
+        for draws in self.sample(num_samples, chunk_size, seed):
+
+            ## Marginal and peak probabilities
+            high = draws > threshold
+            p_high += high.sum(axis=-1)
+            peak = np.argmax(np.nan_to_num(draws, nan=-np.inf), axis=0)
+            p_peak += (peak[None] == np.arange(P)[:, None, None]).sum(axis=-1)
+            num_high += high.sum(axis=(0, -1))
+
+            ## Longest cyclic run, via the run length ending at each period
+            ## over two passes through the year.
+            run = np.zeros(high.shape[1:])
+            longest_run = np.zeros(high.shape[1:])
+            for i in range(2 * P):
+                run = (run + 1.) * high[i % P]
+                longest_run = np.maximum(longest_run, run)
+            longest_run = np.minimum(longest_run, P)
+            p_run += (longest_run >= run_length).sum(axis=-1)
+            longest += longest_run.sum(axis=-1)
+
+        ## Normalize, leaving units without data as NaN
+        missing = self.stats.counts.sum(axis=0) == 0
+        summary = pd.DataFrame({"p_run": p_run / num_samples,
+                                "expected_high": num_high / num_samples,
+                                "expected_longest_run": longest / num_samples},
+                               index=self.countries)
+        summary.loc[missing] = np.nan
+        by_period = pd.concat({"p_high": pd.DataFrame(p_high / num_samples, columns=self.countries),
+                               "p_peak": pd.DataFrame(p_peak / num_samples, columns=self.countries)},
+                              axis=1, names=["statistic"])
+        by_period.loc[:, np.tile(missing, 2)] = np.nan
+        by_period.index.name = "period"
+        return summary, by_period
+
+    def residuals(self):
+        """ ln_cr less the fitted profile, i.e. ln_cr - X @ mu_hat. """
+        return self.ln_cr - self.mu_hat[self.period]
+
+    def leave_one_year_out(self):
+        """ Leave-one-calendar-year-out cross validation for every unit, in closed form. The
+        model is linear, so holding out a year's block B of rows changes the residuals to
+
+            e_loo = inv(I - H_BB) @ e_B, with H_BB = X_B @ inv(A) @ X_B.T,
+
+        and the residual plus prior sum of squares to Q - e_B.T @ e_loo, where A = X.T @ X + pRW2.
+        By the Woodbury identity, inv(I - H_BB) = I + X_B @ inv(A - C_B) @ X_B.T, with
+        C_B = X_B.T @ X_B the diagonal of the year's counts by period, so
+
+            e_loo = e_B + X_B @ inv(A - C_B) @ s_B, with s_B = X_B.T @ e_B,
+
+        and |I - H_BB| = |A - C_B|/|A|. A - C_B is the precision without the held out year, so
+        it's cyclic pentadiagonal as well, and periods that repeat within a year (i.e. weekly or
+        daily data) just add to the counts. The Student-t predictive distribution for the held out
+        year has scale var_B * inv(I - H_BB). Every (unit, year) pair is handled in one batched
+        banded solve, with no refitting.
+
+        Returns a frame, indexed by unit, with the RMSE of the held out residuals and the
+        predictive log score, summed over years and per held out period. """
+
+        ## Observed residuals by (period, unit, year), summing rows
+        ## that share a period within a year.
+        residuals = self.residuals()
+        years, year_index = pd.factorize(residuals.index.year)
+        P, U, Y = len(self.mu_hat), residuals.shape[1], len(year_index)
+        observed = np.isfinite(residuals.values)
+        e = np.where(observed, residuals.values, 0.)
+        units = np.arange(U)[None, :]
+        cell = ((self.period[:, None] * U + units) * Y + years[:, None]).ravel()
+        c = np.bincount(cell, weights=observed.ravel(), minlength=P * U * Y).reshape(P, U, Y)
+        s = np.bincount(cell, weights=e.ravel(), minlength=P * U * Y).reshape(P, U, Y)
+        ss = np.bincount((units * Y + years[:, None]).ravel(), weights=(e**2).ravel(),
+                         minlength=U * Y).reshape(U, Y)
+
+        ## Solves with the down-dated precisions, A - C_B
+        chol = CyclicBandedCholesky(self.precision[0][..., None] - c,
+                                    self.precision[1][..., None],
+                                    self.precision[2][..., None])
+        v = chol.solve(s)
+        logdet_G = chol.logdet() - CyclicBandedCholesky(*self.precision).logdet()[:, None]
+
+        ## Held out sums of squares, e_B.T @ e_loo and e_loo.T @ e_loo,
+        ## and down-dated sums of squares
+        eBe_loo = ss + (s * v).sum(axis=0)
+        sse_loo = ss + 2. * (s * v).sum(axis=0) + (c * v**2).sum(axis=0)
+        k = c.sum(axis=0)
+        dof = self.stats.counts.sum(axis=0) + P - 3
+        Q = self.var * dof
+        Q_B = Q[:, None] - eBe_loo
+        nu = dof[:, None] - k
+        var_B = Q_B / nu
+
+        ## Multivariate Student-t log score for each held out year, using
+        ## e_loo.T @ (I - H_BB) @ e_loo = e_B.T @ e_loo
+        d2 = eBe_loo / var_B
+        logdet = k * np.log(var_B) - logdet_G
+        log_score = (gammaln(0.5 * (nu + k)) - gammaln(0.5 * nu) - 0.5 * k * np.log(nu * np.pi)
+                     - 0.5 * logdet - 0.5 * (nu + k) * np.log(1. + d2 / nu))
+        log_score = np.where(k > 0, log_score, 0.)
+
+        ## Summarize by unit
+        cv = pd.DataFrame({"rmse": np.sqrt(sse_loo.sum(axis=1) / k.sum(axis=1)),
+                           "log_score": log_score.sum(axis=1),
+                           "log_score_per_month": log_score.sum(axis=1) / k.sum(axis=1),
+                           "num_years": (k > 0).sum(axis=1)},
+                           index=self.countries)
+        return cv
+
+class HierarchicalProfileRegression:
+
+    """ Partially pooled profiles for subnational units (admin-1, admin-2, etc.), where each unit's
+    profile is its country's profile plus a deviation,
+
+        mu_u = c_g + d_u, c_g ~ RW2(prior_scale), d_u ~ N(0, var*inv(deviation_scale*(K + ridge*I))),
+
+    with K = D2.T @ D2 and a noise variance shared by the units in a country. The ridge pins down
+    the deviations' level, so that sparsely observed units are shrunk towards their country's
+    profile, and units without data get the country profile.
+
+    The joint precision is block arrow shaped, with a banded block B_u = X_u.T @ X_u + K_d for
+    each unit coupled to a dense block for its country. Eliminating the deviations with the
+    batched banded Cholesky leaves a PxP Schur complement per country,
+
+        S_g = sum_u X_u.T @ X_u @ (I - F_u) + prior_scale*K, F_u = inv(B_u) @ X_u.T @ X_u,
+
+    so the cost is O(P^2) per unit and O(P^3) per country, and tens of thousands of units fit in
+    a fraction of a second.
+
+    tr_data is either a ProfileStatistics object or a wide frame of log case ratios (as in
+    BatchedProfileRegression), in both cases with (Country, unit) multi-index units. With
+    deviation_scale=None, there's no pooling and each unit is fit on its own, as in
+    BatchedProfileRegression. """
+
+    def __init__(self, tr_data, prior_scale=(2.**4) / 4.0, deviation_scale=2.**4, ridge=1.,
+                 periodicity=12):
+        self.tr_data = tr_data
+        self.prior_scale = prior_scale
+        self.deviation_scale = deviation_scale
+        self.ridge = ridge
+        if isinstance(tr_data, ProfileStatistics):
+            self.stats = tr_data
+        else:
+            self.stats = ProfileStatistics.from_wide(tr_data, periodicity)
+        self.countries = self.stats.countries
+        if self.countries.nlevels < 2:
+            raise ValueError("Units need a (Country, unit) multi-index to be pooled.")
+        self.group_codes, self.groups = pd.factorize(self.countries.get_level_values(0))
+
+        ## Without pooling, the single level fit for each unit
+        if deviation_scale is None:
+            fit = BatchedProfileRegression(self.stats, prior_scale)
+            self.mu_hat, self.var, self.sigs = fit.mu_hat, fit.var, fit.sigs
+            self.group_mu_hat = np.full((self.stats.periodicity, len(self.groups)), np.nan)
+            self.group_sigs = np.full((self.stats.periodicity, len(self.groups)), np.nan)
+        else:
+            self._fit(self.stats.counts, self.stats.sums, self.stats.sumsq)
+
+        ## Compute the mean and std errors in the effective R
+        self.reff = np.exp(self.mu_hat + (self.sigs**2) / 2.0)
+        self.reff_err = np.sqrt((np.exp(self.sigs**2) - 1.0)) * self.reff
+        self.reff_low = np.exp(self.mu_hat + np.sqrt(2) * self.sigs * erfinv(2 * 0.1 - 1.0))
+        self.reff_high = np.exp(self.mu_hat + np.sqrt(2) * self.sigs * erfinv(2 * 0.9 - 1.0))
+
+        ## Compute the low season probabilities
+        self.p_low = 0.5 * (1 + erf((-self.mu_hat) / (self.sigs * np.sqrt(2))))
+
+    def _fit(self, counts, sums, sumsq):
+
+        P, U = counts.shape
+        G = len(self.groups)
+        codes = self.group_codes
+
+        ## Factor the deviation blocks, B_u = N_u + K_d, with N_u = X_u.T @ X_u
+        ## diagonal, and solve against [N_u, b_u] together.
+        d_scale = self.deviation_scale
+        deviation_prior = ((6. + self.ridge) * d_scale, -4. * d_scale, 1. * d_scale)
+        chol = CyclicBandedCholesky(counts + deviation_prior[0],
+                                    deviation_prior[1] * np.ones_like(counts),
+                                    deviation_prior[2] * np.ones_like(counts))
+        rhs = np.concatenate([counts[:, :, None] * np.eye(P)[:, None, :], sums[:, :, None]],
+                             axis=-1)
+        solved = chol.solve(rhs)
+        F = np.moveaxis(solved[:, :, :P], 1, 0)
+        f = solved[:, :, P]
+
+        ## Accumulate the Schur complements and the reduced right hand sides
+        ## by country, over units sorted by country.
+        order = np.argsort(codes, kind="stable")
+        starts = np.searchsorted(codes[order], np.arange(G))
+        I_F = np.eye(P)[None] - F
+        S = np.add.reduceat((counts.T[:, :, None] * I_F)[order], starts, axis=0)
+        r = np.add.reduceat((sums - counts * f).T[order], starts, axis=0)
+        scale = (np.asarray(self.prior_scale, dtype=np.float64) * np.ones(G))[:, None, None]
+        S = S + scale * cyclic_matvec(6., -4., 1., np.eye(P))[None]
+
+        ## Country profiles, skipping countries without data
+        has_data = np.add.reduceat(counts.sum(axis=0)[order], starts) > 0
+        S_inv = np.full((G, P, P), np.nan)
+        S_inv[has_data] = np.linalg.inv(S[has_data])
+        c = np.einsum("gij,gj->gi", S_inv, r)
+
+        ## Deviations and unit profiles
+        d = f - np.einsum("uij,uj->iu", F, c[codes])
+        self.group_mu_hat = c.T
+        self.deviation = d
+        self.mu_hat = c[codes].T + d
+
+        ## Shared noise variance for each country, from the residual and prior
+        ## sums of squares, and the same degrees of freedom as the single level fit.
+        RSS = (sumsq - 2. * self.mu_hat * sums + counts * self.mu_hat**2).sum(axis=0)
+        prior_d = (d * cyclic_matvec(*deviation_prior, d)).sum(axis=0)
+        prior_c = scale[:, 0, 0] * (c.T * cyclic_matvec(6., -4., 1., c.T)).sum(axis=0)
+        Q = np.add.reduceat((RSS + prior_d)[order], starts) + prior_c
+        dof = np.add.reduceat(counts.sum(axis=0)[order], starts) + P - 3
+        self.group_var = Q / dof
+        self.var = self.group_var[codes]
+
+        ## Standard errors, with cov(mu_u) = var * (inv(B_u) + (I - F_u) @ inv(S_g) @ (I - F_u).T)
+        diag_inv = chol.diag_inverse() + np.einsum("uij,ujk,uik->iu", I_F, S_inv[codes], I_F)
+        self.sigs = np.sqrt(diag_inv * self.var)
+        self.group_sigs = np.sqrt(np.diagonal(S_inv, axis1=1, axis2=2) * self.group_var[:, None]).T
+
+def circulant_solve(counts, prior_scale, sums):
+    """ mu_hat and the diagonal of inv(X.T @ X + pRW2) via the FFT, for units with the same
+    count in every period. counts and prior_scale have shape (num_units,), and sums has shape
+    (P, num_units). """
+    eig = counts[None, :] + prior_scale[None, :] * rw2_eigenvalues(len(sums))[:, None]
+    mu_hat = np.real(np.fft.ifft(np.fft.fft(sums, axis=0) / eig, axis=0))
+    diag_inv = (1. / eig).mean(axis=0)
+    return mu_hat, diag_inv * np.ones(sums.shape)
+
+def profile_log_evidence(stats, prior_scales):
+    """ Log marginal likelihood of each unit's log case ratios as a function of the RW2 prior
+    strength, for the grid prior_scales (shape (G,)), returned with shape (G, num_units).
+
+    The profile and the noise variance are integrated out, with mu ~ N(0, var*inv(scale*K)),
+    K = D2.T @ D2 (improper in the constant direction), and a 1/var prior on the variance,
+    which gives
+
+    log p(y | scale) = (P-1)/2 log(scale) + 1/2 log|K|_+ - 1/2 log|A| - (T-1)/2 log(pi Q) + lgamma((T-1)/2)
+
+    with A = X.T @ X + scale*K and Q = y.T @ y - b.T @ inv(A) @ b, b = X.T @ y. Units with
+    balanced counts are evaluated with the FFT for every grid point at once, the others with a
+    single batched banded factorization over the (grid, unit) pairs. Units without data are
+    NaN, as in BatchedProfileRegression. """
+
+    ## Set up
+    scales = np.asarray(prior_scales, dtype=np.float64)
+    counts, sums, sumsq = stats.counts, stats.sums, stats.sumsq
+    P, U = counts.shape
+    G = len(scales)
+    eig = rw2_eigenvalues(P)
+    T = counts.sum(axis=0)
+
+    ## log|A| and b.T @ inv(A) @ b, shape (G,U), skipping
+    ## units without data
+    logdet = np.full((G, U), np.nan)
+    bAb = np.full((G, U), np.nan)
+    has_data = T > 0
+    balanced = (counts == counts[:1]).all(axis=0) & has_data
+    banded = has_data & ~balanced
+    if balanced.any():
+        A_eig = counts[0, balanced][None, None, :] + scales[:, None, None] * eig[None, :, None]
+        b_hat = np.abs(np.fft.fft(sums[:, balanced], axis=0))**2
+        logdet[:, balanced] = np.log(A_eig).sum(axis=1)
+        bAb[:, balanced] = (b_hat[None] / A_eig).sum(axis=1) / P
+    if banded.any():
+        c = counts[:, None, banded]
+        b = sums[:, None, banded]
+        s = scales[None, :, None]
+        chol = CyclicBandedCholesky(c + 6. * s, -4. * s, s)
+        logdet[:, banded] = chol.logdet()
+        bAb[:, banded] = (b * chol.solve(b)).sum(axis=0)
+
+    ## Put it together
+    Q = sumsq.sum(axis=0)[None, :] - bAb
+    log_pdet_K = np.log(eig[1:]).sum()
+    return (0.5 * (P - 1) * np.log(scales)[:, None] + 0.5 * log_pdet_K - 0.5 * logdet
+            - 0.5 * (T - 1) * np.log(np.pi * Q) + gammaln(0.5 * (T - 1)))
+
+def select_prior_scale(stats, prior_scales=2.**np.arange(-6, 10.5, 0.5)):
+    """ The RW2 prior strength with the highest marginal likelihood on the grid prior_scales,
+    for each unit, and NaN for units without data. The result can be passed to
+    BatchedProfileRegression. """
+    log_evidence = profile_log_evidence(stats, prior_scales)
+    has_data = stats.counts.sum(axis=0) > 0
+    best = np.full(len(has_data), np.nan)
+    best[has_data] = np.asarray(prior_scales)[np.argmax(log_evidence[:, has_data], axis=0)]
+    return pd.Series(best, index=stats.countries, name="prior_scale")
+
 if __name__ == "__main__":
 
     ## Import plotting related libraries and
@@ -128,13 +718,8 @@ if __name__ == "__main__":
 
     ## Create the trig interpolant design matrix for
     ## periodic interpolation
-    tk = np.arange(1.,len(logt.mu_hat)+1.)
     t = np.linspace(1.,len(logt.mu_hat)+1.,395)
-    dt = (t[:,None]-tk[None,:])
-    with warnings.catch_warnings():
-        warnings.simplefilter("ignore")
-        X_int = np.sin(np.pi*dt)/(12*np.tan(np.pi*dt/12.))
-        X_int = np.nan_to_num(X_int,nan=1.)
+    X_int = trig_interpolant(t,len(logt.mu_hat))
 
     ## plot each country panel
     for i, country in enumerate(logt.ln_cr.columns):
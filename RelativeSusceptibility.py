@@ -13,6 +13,7 @@ import matplotlib.pyplot as plt
 from Profiles import ProfileRegression
 from utils import process_case_data,\
                   process_sia_calendar,\
+                  sia_dose_covariate,\
                   axes_setup
 
 ## Plot environment
@@ -43,7 +44,7 @@ def demographic_pressure(profiles,stability_extent=1):
 
     ## Reshape
     alphas = pd.DataFrame(alphas,
-        columns=profiles.ln_cr.columns,
+        columns=profiles.countries,
         ).T
 
     return alphas
@@ -141,6 +142,9 @@ if __name__ == "__main__":
                 values="Cases")
     cases = cases.loc[start_date:][profiles.ln_cr.columns]
 
+    ## Create the SIA vax covariate for every country at once
+    sia_vax = sia_dose_covariate(sia_cal,cases.index,cases.columns)
+
     ## Make the figure layout
     fig, axes = plt.subplots(2,2,figsize=(14,7.5),sharex=True)
     axes = axes.reshape(-1)
@@ -150,21 +154,8 @@ if __name__ == "__main__":
     ## Loop over countries, compute and plot
     for i, country in enumerate(countries_list):
 
-        ## Compute the WHO rec. First get the most recent SIA
-        cal = sia_cal.loc[(sia_cal["Country"] == country) &\
-                          (sia_cal["time"].notnull())]
-
-        ## Create a SIA vax covariate
-        vax = cal[["time","doses"]]\
-            .dropna()\
-            .sort_values("time")\
-            .set_index("time")["doses"]
-        vax = pd.DataFrame(np.diag(vax.values),
-                        index=vax.index,columns=vax.index)
-        vax = vax.resample("MS").sum()
-        vax.index = vax.index + pd.to_timedelta(14,unit="d")
-        vax = vax.reindex(cases.index)\
-                .fillna(0).sum(axis=1)/1.e6
+        ## The SIA vax covariate
+        vax = sia_vax[country]
 
         ## Compute the relative susceptibility estimate, recomputing across years
         ## until you find a stable solution.
@@ -0,0 +1,192 @@
+""" banded.py
+
+Cyclic banded linear algebra for the RW2 profile regressions. Matrices are symmetric,
+periodic, and pentadiagonal (the RW2 precision plus a diagonal of data counts), and are
+stored by their diagonals so that many independent systems can be factored and solved together
+in O(P) work per system. """
+
+import numpy as np
+
+def cyclic_matvec(d0, d1, d2, x):
+    """ Product A @ x for the symmetric cyclic pentadiagonal matrix with diagonals d0, d1, d2, where
+    d1[i] = A[i,i+1] and d2[i] = A[i,i+2] (indices mod P). x has shape (P,...) and broadcasts
+    against the diagonals along the trailing axes. """
+    d0, d1, d2 = [_expand(d, x.ndim) for d in (d0, d1, d2)]
+    return (d0*x
+            + d1*np.roll(x,-1,axis=0) + np.roll(d1*x,1,axis=0)
+            + d2*np.roll(x,-2,axis=0) + np.roll(d2*x,2,axis=0))
+
+def rw2_eigenvalues(P):
+    """ Eigenvalues of the cyclic RW2 precision D2.T @ D2, i.e. the circulant with stencil
+    (1, -4, 6, -4, 1), in FFT order. """
+    return 16. * np.sin(np.pi * np.arange(P) / P)**4
+
+def _expand(a, ndim):
+    """ Right-pad a's shape with singleton axes so it broadcasts against an ndim array. """
+    a = np.asarray(a)
+    return a.reshape(a.shape + (ndim - a.ndim)*(1,))
+
+class CyclicBandedCholesky:
+
+    """ Batched Cholesky factorization, A = L @ L.T, of symmetric positive definite cyclic
+    pentadiagonal matrices. d0, d1, and d2 have shape (P,...) with the trailing axes indexing
+    independent systems (see cyclic_matvec for the convention).
+
+    The periodic corners only fill in the last two rows of L, so the factor is stored as a lower
+    band for the leading (P-2)x(P-2) block, two dense rows (W), and a 2x2 trailing block. """
+
+    def __init__(self, d0, d1, d2):
+
+        ## Broadcast the diagonals to a common shape
+        d0, d1, d2 = [np.array(d, dtype=np.float64) for d in np.broadcast_arrays(d0, d1, d2)]
+        self.P = P = d0.shape[0]
+        if P < 5:
+            raise ValueError("Cyclic pentadiagonal systems need at least 5 periods.")
+        self.m = m = P - 2
+        self.d0, self.d1, self.d2 = d0, d1, d2
+
+        ## Lower band of the leading block, with L0[i] = L[i,i],
+        ## L1[i] = L[i,i-1], and L2[i] = L[i,i-2].
+        L0 = np.zeros((m,) + d0.shape[1:])
+        L1 = np.zeros_like(L0)
+        L2 = np.zeros_like(L0)
+        for i in range(m):
+            if i >= 2:
+                L2[i] = d2[i-2]/L0[i-2]
+            if i >= 1:
+                L1[i] = (d1[i-1] - L2[i]*L1[i-1])/L0[i-1]
+            L0[i] = np.sqrt(d0[i] - L1[i]**2 - L2[i]**2)
+
+        ## The dense rows of L coupling the last two periods
+        ## to the leading block, computed by forward substitution.
+        W = np.zeros((2, m) + d0.shape[1:])
+        for r in range(2):
+            for j in range(m):
+                W[r,j] = self._entry(m+r, j)
+                if j >= 1:
+                    W[r,j] -= W[r,j-1]*L1[j]
+                if j >= 2:
+                    W[r,j] -= W[r,j-2]*L2[j]
+                W[r,j] /= L0[j]
+
+        ## And finally the trailing 2x2 block
+        T00 = d0[m] - (W[0]**2).sum(axis=0)
+        T10 = d1[m] - (W[0]*W[1]).sum(axis=0)
+        T11 = d0[m+1] - (W[1]**2).sum(axis=0)
+        t00 = np.sqrt(T00)
+        t10 = T10/t00
+        t11 = np.sqrt(T11 - t10**2)
+        self.L0, self.L1, self.L2 = L0, L1, L2
+        self.W = W
+        self.T = np.array([t00, t10, t11])
+
+    def _entry(self, i, j):
+        """ A[i,j] from the diagonal storage. """
+        offset = (j - i) % self.P
+        if offset == 0:
+            return self.d0[i]
+        elif offset == 1:
+            return self.d1[i]
+        elif offset == 2:
+            return self.d2[i]
+        elif offset == self.P - 1:
+            return self.d1[j]
+        elif offset == self.P - 2:
+            return self.d2[j]
+        return np.zeros(self.d0.shape[1:])
+
+    def _promote(self, b):
+        """ Right-pad b so it has at least the batch axes of the factor. """
+        b = np.asarray(b, dtype=np.float64)
+        if b.ndim < self.d0.ndim:
+            b = _expand(b, self.d0.ndim)
+        return b
+
+    def diag(self):
+        """ The diagonal of L, shape (P,...). """
+        return np.concatenate([self.L0, self.T[[0, 2]]], axis=0)
+
+    def logdet(self):
+        """ log|A| for each system. """
+        return 2.*np.log(self.diag()).sum(axis=0)
+
+    def solve_lower(self, b):
+        """ Solve L @ y = b. b has shape (P,...) with trailing axes broadcasting against the
+        batch, i.e. b can carry extra right hand sides on axes past the batch axes. """
+        b = self._promote(b)
+        L0, L1, L2 = [_expand(a, b.ndim) for a in (self.L0, self.L1, self.L2)]
+        W = _expand(self.W, b.ndim+1)
+        T = _expand(self.T, b.ndim)
+        m = self.m
+        y = np.zeros(np.broadcast(b, _expand(self.d0, b.ndim)).shape)
+        for i in range(m):
+            r = b[i]
+            if i >= 1:
+                r = r - L1[i]*y[i-1]
+            if i >= 2:
+                r = r - L2[i]*y[i-2]
+            y[i] = r/L0[i]
+        y[m] = (b[m] - (W[0]*y[:m]).sum(axis=0))/T[0]
+        y[m+1] = (b[m+1] - (W[1]*y[:m]).sum(axis=0) - T[1]*y[m])/T[2]
+        return y
+
+    def solve_upper(self, y):
+        """ Solve L.T @ x = y, with the same broadcasting as solve_lower. """
+        y = self._promote(y)
+        L0, L1, L2 = [_expand(a, y.ndim) for a in (self.L0, self.L1, self.L2)]
+        W = _expand(self.W, y.ndim+1)
+        T = _expand(self.T, y.ndim)
+        m = self.m
+        x = np.zeros(np.broadcast(y, _expand(self.d0, y.ndim)).shape)
+        x[m+1] = y[m+1]/T[2]
+        x[m] = (y[m] - T[1]*x[m+1])/T[0]
+        for i in range(m-1, -1, -1):
+            r = y[i] - W[0,i]*x[m] - W[1,i]*x[m+1]
+            if i + 1 < m:
+                r = r - L1[i+1]*x[i+1]
+            if i + 2 < m:
+                r = r - L2[i+2]*x[i+2]
+            x[i] = r/L0[i]
+        return x
+
+    def solve(self, b):
+        """ Solve A @ x = b. """
+        return self.solve_upper(self.solve_lower(b))
+
+    def inverse(self):
+        """ Dense inverse of each system, shape (P,P,...). This costs O(P^2) per system, so it's
+        meant for a handful of systems (i.e. plotting), not the whole batch at large P. """
+        eye = np.eye(self.P).reshape((self.P,) + (self.d0.ndim - 1)*(1,) + (self.P,))
+        return np.moveaxis(self.solve(eye), -1, 1)
+
+    def diag_inverse(self):
+        """ The diagonal of inv(A) via the Takahashi recursions, which only visit entries of the
+        inverse on the sparsity pattern of L, so the cost is O(P) per system. """
+
+        m = self.m
+        Ld = self.diag()
+
+        ## Non-zero entries of L below the diagonal, by column
+        def column(j):
+            entries = []
+            if j < m:
+                if j + 1 < m:
+                    entries.append((j+1, self.L1[j+1]))
+                if j + 2 < m:
+                    entries.append((j+2, self.L2[j+2]))
+                entries.append((m, self.W[0,j]))
+                entries.append((m+1, self.W[1,j]))
+            elif j == m:
+                entries.append((m+1, self.T[1]))
+            return entries
+
+        ## Sweep backwards over columns, storing Z = inv(A) on
+        ## the pattern in a dictionary keyed by (row, col), row >= col.
+        Z = {}
+        get = lambda i, k: Z[(i, k)] if i >= k else Z[(k, i)]
+        for j in range(self.P-1, -1, -1):
+            entries = column(j)
+            for i, _ in entries[::-1]:
+                Z[(i, j)] = -sum(l*get(i, k) for k, l in entries)/Ld[j]
+            Z[(j, j)] = (1./Ld[j] - sum(l*Z[(k, j)] for k, l in entries))/Ld[j]
+        return np.array([Z[(j, j)] for j in range(self.P)])
@@ -0,0 +1,289 @@
+""" BuildGraph.py
+
+A small build graph for the pipeline's artifacts, the pickles, modeling dataset, and figures in
+outputs/ and the model outputs (the *_tsir_df.csv, *_sia_comparisons.csv, and tsir_profiles.csv
+files) in data/. Each node is a script run with some arguments, and its key is a hash of the script,
+the shared modules it uses, its arguments, and the contents of its inputs. Keys are recorded in
+outputs/build_state.json, and a node is rebuilt only if its key changed or its outputs are
+missing or were modified since the last build.
+
+Nodes are visited in dependency order, so a node's key is computed after its inputs are
+refreshed. If a rebuilt upstream artifact comes out the same, the nodes downstream of it are left
+alone. Independent nodes run in parallel, as subprocesses with a non-interactive matplotlib
+backend. Run it from this directory, like the other scripts, e.g.
+
+python BuildGraph.py                  (refresh everything that's stale)
+python BuildGraph.py modeling_dataset (refresh one node and what it depends on)
+python BuildGraph.py --dry-run        (just report what's stale) """
+
+import os
+import sys
+import json
+import hashlib
+import argparse
+import subprocess
+import time as timer
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+## Standard imports
+import pandas as pd
+
+## Where the state and logs live
+STATE = os.path.join("..","outputs","build_state.json")
+LOGS = os.path.join("..","outputs","build_logs")
+
+## Shared modules, by what the scripts import
+DATA_ANALYSIS_CODE = [os.path.join("utils",m) for m in ("panel.py","countries.py",
+                                                         "gavi_countries.py")]
+MODEL_CODE = [os.path.join("utils",m) for m in ("tsir.py","dataset.py","vis.py")]
+
+class Node:
+
+    """ An artifact-producing step: a script (path relative to this directory) run from its
+    own directory with args, reading inputs and writing outputs. code lists the modules the
+    script depends on beyond itself. """
+
+    def __init__(self,name,script,inputs,outputs,args=(),code=()):
+        self.name = name
+        self.script = script
+        self.inputs = list(inputs)
+        self.outputs = list(outputs)
+        self.args = [str(a) for a in args]
+        self.code = [script]+list(code)
+
+    def key(self,hasher):
+        """ Hash of everything the outputs depend on. """
+        spec = {"args":self.args,
+                "code":{p:hasher(p) for p in self.code},
+                "inputs":{p:hasher(p) for p in self.inputs}}
+        return hashlib.sha256(json.dumps(spec,sort_keys=True).encode()).hexdigest()
+
+    def run(self,log):
+        """ Run the script, writing its output to log, and return the exit code. """
+        env = dict(os.environ,MPLBACKEND="Agg")
+        with open(log,"w") as f:
+            return subprocess.run([sys.executable,os.path.basename(self.script)]+self.args,
+                                  cwd=os.path.dirname(self.script) or ".",
+                                  env=env,stdout=f,stderr=subprocess.STDOUT).returncode
+
+def PipelineNodes(tsir_countries=("chad","kenya","nepal"),
+                  comparison_countries=("chad","kenya")):
+
+    """ The graph for the scripts in data_analysis/ and this directory. Nodes run in
+    parallel, so every file a script writes is declared as an output, and no two nodes
+    write the same file. """
+
+    data = lambda f: os.path.join("..","data",f)
+    outputs = lambda f: os.path.join("..","outputs",f)
+    analysis = lambda f: os.path.join("data_analysis",f)
+    dataset = outputs("modeling_dataset")
+
+    nodes = [Node("births",analysis("Births.py"),
+                  [data("worldbank_totalpopulation_Aug2023.csv"),
+                   data("worldbank_crudebirthrate_Aug2023.csv")],
+                  [outputs("births.pkl")],
+                  code=DATA_ANALYSIS_CODE),
+             Node("coverage",analysis("RI.py"),
+                  [data("coverage_estimates_Aug2023.csv")],
+                  [outputs("mcv1.pkl"),outputs("mcv2.pkl")],
+                  code=DATA_ANALYSIS_CODE),
+             Node("cases",analysis("CaseData.py"),
+                  [data("measlescasesbycountrybymonth_Mar2024.csv")],
+                  [outputs("epi_curves.pkl"),outputs("raw_cases.pkl")],
+                  code=DATA_ANALYSIS_CODE+[os.path.join("..","who_cases.py")]),
+             Node("target_pop",analysis("SIACalendar.py"),
+                  [data("Summary_MR_SIA.csv")],
+                  [outputs("target_pop.pkl")],
+                  code=DATA_ANALYSIS_CODE),
+             Node("modeling_dataset","PrepareModelingDataset.py",
+                  [outputs(f) for f in ("epi_curves.pkl","mcv1.pkl","mcv2.pkl",
+                                        "births.pkl","target_pop.pkl")],
+                  [dataset],
+                  code=[os.path.join("utils",m) for m in ("panel.py","dataset.py",
+                                                          "countries.py","vis.py")]),
+             Node("tsir_profiles","SeasonalityEstimates.py",
+                  [dataset],[data("tsir_profiles.csv")],
+                  code=MODEL_CODE),
+             Node("tsir_fits","FitAllCountries.py",
+                  [dataset],[outputs("tsir_fits.csv")],
+                  code=MODEL_CODE+[os.path.join("utils","gavi_countries.py")])]
+    for c in tsir_countries:
+        nodes.append(Node("{}_tsir_df".format(c),"ExtrapolateModel.py",
+                          [dataset],
+                          [data("{}_tsir_df.csv".format(c.replace(" ",""))),
+                           outputs("{}_volatility_illustration.png".format(c.replace(" ","")))],
+                          args=[c],code=MODEL_CODE))
+    for c in comparison_countries:
+        nodes.append(Node("{}_sia_comparisons".format(c),"ScenarioSetCompare.py",
+                          [dataset],[data("{}_sia_comparisons.csv".format(c.replace(" ","")))],
+                          args=[c],code=MODEL_CODE))
+    return nodes
+
+class ContentHasher:
+
+    """ SHA-256 of files (and, for directories, of their sorted contents). Hashes are cached
+    by size and modification time, so unchanged raw data isn't re-read on every build. """
+
+    def __init__(self,cache=None):
+        self.cache = {} if cache is None else cache
+
+    def __call__(self,path):
+        if os.path.isdir(path):
+            sha = hashlib.sha256()
+            for name in sorted(os.listdir(path)):
+                sha.update(name.encode())
+                sha.update(self(os.path.join(path,name)).encode())
+            return sha.hexdigest()
+        if not os.path.exists(path):
+            return None
+        stat = os.stat(path)
+        stamp = [stat.st_size,stat.st_mtime_ns]
+        cached = self.cache.get(path)
+        if cached is not None and cached[:2] == stamp:
+            return cached[2]
+        sha = hashlib.sha256()
+        with open(path,"rb") as f:
+            for block in iter(lambda: f.read(2**20),b""):
+                sha.update(block)
+        self.cache[path] = stamp+[sha.hexdigest()]
+        return self.cache[path][2]
+
+    def invalidate(self,paths):
+        """ Forget cached hashes, i.e. after a node rewrites its outputs. """
+        for p in paths:
+            for k in [k for k in self.cache if k == p or k.startswith(p+os.sep)]:
+                del self.cache[k]
+
+def load_state(path=STATE):
+    if os.path.exists(path):
+        with open(path) as f:
+            return json.load(f)
+    return {"nodes":{},"files":{}}
+
+def save_state(state,path=STATE):
+    tmp = path+".tmp"
+    with open(tmp,"w") as f:
+        json.dump(state,f,indent=1,sort_keys=True)
+    os.replace(tmp,path)
+
+def upstream(nodes,targets):
+    """ The dependencies of each node (by name), restricted to the targets and everything
+    they depend on. """
+    producers = {o:n.name for n in nodes for o in n.outputs}
+    deps = {n.name:{producers[i] for i in n.inputs if i in producers} for n in nodes}
+    needed = set()
+    stack = list(targets)
+    while stack:
+        name = stack.pop()
+        if name not in needed:
+            needed.add(name)
+            stack.extend(deps[name])
+    return {k:v for k,v in deps.items() if k in needed}
+
+def Build(nodes,targets=None,max_workers=None,force=False,dry_run=False):
+
+    """ Bring the targets (node names, all by default) up to date, rebuilding stale nodes
+    in parallel where the graph allows. Returns a dataframe with each node's status and
+    time taken. In a dry run, stale nodes are reported (as if their outputs change) but
+    not run. """
+
+    by_name = {n.name:n for n in nodes}
+    written = [o for n in nodes for o in n.outputs]
+    shared = sorted({o for o in written if written.count(o) > 1})
+    if shared:
+        raise ValueError("Outputs {} are written by more than one node.".format(shared))
+    targets = list(by_name) if targets is None else list(targets)
+    unknown = [t for t in targets if t not in by_name]
+    if unknown:
+        raise ValueError("Unknown nodes {}, choose from {}.".format(unknown,list(by_name)))
+    deps = upstream(nodes,targets)
+
+    state = load_state()
+    hasher = ContentHasher(state["files"])
+    os.makedirs(LOGS,exist_ok=True)
+
+    ## Walk the graph, starting nodes whose dependencies are done
+    pending = set(deps)
+    finished = {}
+    running = {}
+    report = {}
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while pending or running:
+
+            ## Start (or skip) everything that's ready
+            progress = True
+            while progress:
+                progress = False
+                for name in sorted(pending):
+                    if not deps[name] <= set(finished):
+                        continue
+                    pending.remove(name)
+                    progress = True
+                    node = by_name[name]
+                    if any(finished[d] in ("failed","blocked") for d in deps[name]):
+                        finished[name] = report[name] = "blocked"
+                        continue
+                    if dry_run and any(finished[d] == "stale" for d in deps[name]):
+                        finished[name] = report[name] = "stale"
+                        continue
+                    key = node.key(hasher)
+                    record = state["nodes"].get(name,{})
+                    current = (record.get("key") == key) and \
+                              all(hasher(o) is not None and hasher(o) == record.get("outputs",{}).get(o)
+                                  for o in node.outputs)
+                    if current and not force:
+                        finished[name] = report[name] = "up to date"
+                    elif dry_run:
+                        finished[name] = report[name] = "stale"
+                    else:
+                        log = os.path.join(LOGS,name+".log")
+                        running[executor.submit(_timed_run,node,log)] = (name,key)
+
+            if not running:
+                continue
+
+            ## Wait for something to finish and record it
+            done, _ = wait(running,return_when=FIRST_COMPLETED)
+            for future in done:
+                name, key = running.pop(future)
+                node = by_name[name]
+                code, seconds = future.result()
+                hasher.invalidate(node.outputs)
+                if code == 0 and all(os.path.exists(o) for o in node.outputs):
+                    state["nodes"][name] = {"key":key,
+                                            "args":node.args,
+                                            "outputs":{o:hasher(o) for o in node.outputs}}
+                    finished[name] = "rebuilt"
+                    report[name] = "rebuilt in {:.1f}s".format(seconds)
+                else:
+                    state["nodes"].pop(name,None)
+                    finished[name] = "failed"
+                    report[name] = "failed (see {})".format(os.path.join(LOGS,name+".log"))
+                save_state(state)
+
+    if not dry_run:
+        save_state(state)
+    return pd.Series(report,name="status").loc[[n.name for n in nodes if n.name in report]]
+
+def _timed_run(node,log):
+    tic = timer.time()
+    code = node.run(log)
+    return code, timer.time()-tic
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Rebuild stale pipeline artifacts.")
+    parser.add_argument("targets",nargs="*",help="nodes to bring up to date (default: all)")
+    parser.add_argument("--jobs",type=int,default=None,help="maximum parallel nodes")
+    parser.add_argument("--force",action="store_true",help="rebuild even if up to date")
+    parser.add_argument("--dry-run",action="store_true",help="only report stale nodes")
+    args = parser.parse_args()
+
+    tic = timer.time()
+    report = Build(PipelineNodes(),
+                   targets=args.targets or None,
+                   max_workers=args.jobs,
+                   force=args.force,
+                   dry_run=args.dry_run)
+    print(report.to_string())
+    print("Total: {:.1f} seconds".format(timer.time()-tic))
@@ -3,6 +3,7 @@
 Fit a basic TSIR model and extrapolate under different scenarios (i.e. campaign timings and
 RI increases and decreases, etc.). """
 import os
+import sys
 
 ## Standard imports
 import numpy as np
@@ -12,6 +13,7 @@ import matplotlib.pyplot as plt
 ## TSIR models, visualization 
 ## utitlies
 import utils.tsir as tsir
+from utils.dataset import ModelingDataset
 from utils.vis import *
 
 ## For R2 scores
@@ -89,11 +91,11 @@ def axes_setup(axes):
 
 if __name__ == "__main__":
 
-    ## Get the dataset
-    country = "chad"
-    df = pd.read_pickle(os.path.join("..","outputs","modeling_dataset.pkl"))
-    df = df.loc[country]
-    df = df.loc["2014-01-01":]
+    ## Get the dataset, for the country given on the
+    ## command line (chad by default)
+    country = sys.argv[1] if len(sys.argv) > 1 else "chad"
+    dataset = ModelingDataset(os.path.join("..","outputs","modeling_dataset"))
+    df = dataset.frame(country,start="2014-01-01")
 
     ## Print the dataset
     print("\nInput dataset for {}".format(country.title()))
@@ -173,7 +175,8 @@ if __name__ == "__main__":
     axes[0].ticklabel_format(style='sci',scilimits=(0,0),axis="y")
     axes[1].ticklabel_format(style='sci',scilimits=(0,0),axis="y")
     fig.tight_layout()
-    fig.savefig(os.path.join("..","outputs","volatility_illustration.png"))
+    fig.savefig(os.path.join("..","outputs",
+                "{}_volatility_illustration.png".format(country.replace(" ",""))))
 
     ## Plot the results
     fig, axes = plt.subplots(2,1,sharex=True,figsize=(12,9))
@@ -0,0 +1,150 @@
+""" FitAllCountries.py
+
+Fit the basic TSIR model for every gavi country in parallel. Country fits are independent, so
+they're distributed over a process pool, with each worker reading its country from the shared,
+memory-mapped modeling dataset (which pickles as its path, so nothing big is sent to the workers).
+A failed fit (one that raises or where the optimizer doesn't converge) is recorded with its
+error rather than stopping the run, and the transmission models and reporting rates are gathered
+into one table with a row per country. """
+
+import os
+
+## Each worker is single threaded, so keep numerical libraries from
+## starting their own thread pools and competing for the same cores.
+for var in ("OMP_NUM_THREADS","OPENBLAS_NUM_THREADS","MKL_NUM_THREADS"):
+    os.environ.setdefault(var,"1")
+
+import warnings
+import time as timer
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+## Standard imports
+import numpy as np
+import pandas as pd
+
+## TSIR model functions
+import utils.tsir as tsir
+from utils.dataset import ModelingDataset
+from utils.gavi_countries import countries
+
+def FitCountry(dataset,country,start="2014-01-01"):
+
+    """ Fit the basic TSIR model for one country. Returns the fitted dataframe, the
+    transmission model, the reporting rate, and the long term R2 at the fitted SIA efficacies. """
+
+    df = dataset.frame(country,start=start)
+    df, model, rr = tsir.FitTSIRModel(df,
+                                      tsir.BasicSusceptibleReconstruction,
+                                      tsir.BasicTransmissionRegression,
+                                      verbose=False)
+    sias = df["target_pop"] != 0.
+    theta = (df.loc[sias,"sia"]/df.loc[sias,"target_pop"]).values
+    r2 = tsir.LongTermR2Score(theta,df,
+                              tsir.BasicSusceptibleReconstruction,
+                              tsir.BasicTransmissionRegression)
+    return df, model, rr, r2
+
+def _fit_country(args):
+
+    """ Worker for the pool, catching any failure so it's recorded against the country,
+    along with fits where the optimizer didn't converge. Numerical warnings from fits that
+    break down are silenced, since the failure itself is recorded. """
+
+    dataset, country, start = args
+    tic = timer.time()
+    try:
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore",category=RuntimeWarning)
+            df, model, rr, r2 = FitCountry(dataset,country,start)
+        error = None if model["success"] else "Not converged: {}".format(model["message"])
+        return {"country":country,"model":model,"reporting_rate":rr,"r2":r2,
+                "num_sias":int((df["target_pop"] != 0.).sum()),
+                "error":error,"seconds":timer.time()-tic}
+    except Exception as e:
+        return {"country":country,"model":None,"error":"{}: {}".format(type(e).__name__,e),
+                "seconds":timer.time()-tic}
+
+def model_row(result):
+
+    """ Flatten a worker's result into a row of the results table, with the seasonal
+    transmission rates spread over columns t_beta_0, t_beta_1, etc. """
+
+    row = {"country":result["country"],
+           "status":"ok" if result["error"] is None else "failed",
+           "error":result["error"],
+           "seconds":result["seconds"]}
+    model = result["model"]
+    if model is None:
+        return row
+    row.update({"reporting_rate":result["reporting_rate"],
+                "r2":result["r2"],
+                "num_sias":result["num_sias"],
+                "alpha":model["alpha"],
+                "alpha_std":model["alpha_std"],
+                "S_bar":model["S_bar"],
+                "S_bar_std":model["S_bar_std"],
+                "std_logE":model["std_logE"],
+                "scale_factor":model["scale_factor"],
+                "periodicity":model["periodicity"]})
+    for i, (t_beta, t_sig) in enumerate(zip(model["t_beta"],model["t_beta_sig"])):
+        row["t_beta_{}".format(i)] = t_beta
+        row["t_beta_sig_{}".format(i)] = t_sig
+    return row
+
+def FitAllCountries(dataset,countries,start="2014-01-01",max_workers=None,verbose=True):
+
+    """ Fit every country in countries over a process pool. Returns the results table,
+    indexed by country, and a dictionary of the transmission models for the countries that
+    fit. Countries missing from the dataset, fits that don't converge, and fits that raise
+    (or take a worker down with them) show up as failed rows with the error. """
+
+    ## Countries with more SIAs take longer, so start those first
+    ## to keep the workers busy at the end of the run.
+    jobs = []
+    rows = []
+    for country in countries:
+        if country not in dataset:
+            rows.append({"country":country,"status":"failed",
+                         "error":"Not in the modeling dataset.","seconds":0.})
+            continue
+        tp = dataset.arrays(country,["target_pop"])["target_pop"]
+        jobs.append((int((tp != 0.).sum()),country))
+    jobs = [(dataset,c,start) for _, c in sorted(jobs,reverse=True)]
+
+    ## Fit in parallel, collecting results as they come in
+    models = {}
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(_fit_country,job):job[1] for job in jobs}
+        for future in as_completed(futures):
+            try:
+                result = future.result()
+            except Exception as e:
+                result = {"country":futures[future],"model":None,
+                          "error":"{}: {}".format(type(e).__name__,e),"seconds":np.nan}
+            if result["error"] is None:
+                models[result["country"]] = result["model"]
+            rows.append(model_row(result))
+            if verbose:
+                print("{} {} ({:.1f}s)".format(result["country"].title(),
+                      "fit" if result["error"] is None else "failed: "+result["error"],
+                      result["seconds"]))
+
+    table = pd.DataFrame(rows).set_index("country").sort_index()
+    return table, models
+
+if __name__ == "__main__":
+
+    ## Get the dataset
+    dataset = ModelingDataset(os.path.join("..","outputs","modeling_dataset"))
+
+    ## Fit everything
+    tic = timer.time()
+    table, models = FitAllCountries(dataset,sorted(countries))
+    elapsed = timer.time()-tic
+
+    ## Summarize and serialize
+    print("\nFits:")
+    print(table[["status","num_sias","reporting_rate","alpha","S_bar","r2","seconds"]])
+    print("\n{} of {} countries fit in {:.1f} seconds ({:.1f} seconds of fitting).".format(
+          (table["status"] == "ok").sum(),len(table),elapsed,table["seconds"].sum()))
+    table.to_csv(os.path.join("..","outputs","tsir_fits.csv"))
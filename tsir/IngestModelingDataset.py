@@ -0,0 +1,119 @@
+""" IngestModelingDataset.py
+
+Single entry point for the modeling dataset. The raw sources (the WHO case spreadsheet, the
+World Bank population and birth rate files, the WUENIC coverage estimates, and the SIA calendar)
+are read and parsed concurrently in a thread pool, and the results are assembled in memory, so
+there's no pickle round-trip through outputs/ between the data_analysis/ steps and
+PrepareModelingDataset. Threads (rather than processes) keep every reader on the same country
+registry, so the codes they join on agree. """
+
+import os
+import sys
+import time as timer
+from concurrent.futures import ThreadPoolExecutor
+
+## Standard imports
+import pandas as pd
+
+## The readers in data_analysis/, next to this file
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),"data_analysis"))
+import Births
+import RI
+import CaseData
+import SIACalendar
+
+## Assembly and storage
+from utils.gavi_countries import countries
+from PrepareModelingDataset import CombineSeries
+from utils.dataset import WriteModelingDataset
+
+## The readers, each of which parses one raw source,
+## with the settings used by the data_analysis scripts
+def read_cases(root,countries):
+    return CaseData.GetEpiCurveSeries(root,countries=countries)
+
+def read_population(root,countries):
+    return Births.get_raw_spreadsheet(root,fname="worldbank_totalpopulation_Aug2023.csv",
+                                      years=(2009,2022))
+
+def read_birthrate(root,countries):
+    return Births.get_raw_spreadsheet(root,fname="worldbank_crudebirthrate_Aug2023.csv",
+                                      years=(2009,2022))
+
+def read_coverage(root,countries):
+    return RI.GetCoverageSeriesSet(["MCV1","MCV2"],root,
+                                   fname="coverage_estimates_Aug2023.csv",
+                                   countries=countries,
+                                   years=(2009,2023))
+
+def read_sia_calendar(root,countries):
+    return SIACalendar.get_raw_spreadsheet(root)
+
+SOURCES = {"cases":read_cases,
+           "population":read_population,
+           "birthrate":read_birthrate,
+           "coverage":read_coverage,
+           "sia_calendar":read_sia_calendar}
+
+def _timed(reader,root,countries):
+    tic = timer.time()
+    result = reader(root,countries)
+    return result, timer.time()-tic
+
+def ReadSources(root,countries,max_workers=None):
+
+    """ Read every raw source concurrently. Returns a dictionary of the parsed sources and
+    a series of the time (in seconds) each one took. """
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {k:executor.submit(_timed,reader,root,countries)
+                   for k, reader in SOURCES.items()}
+        results = {k:f.result() for k, f in futures.items()}
+    sources = {k:r[0] for k, r in results.items()}
+    timings = pd.Series({k:r[1] for k, r in results.items()},name="seconds")
+    return sources, timings
+
+def AssembleSeries(sources,countries):
+
+    """ The semi-monthly (country, time) series for CombineSeries, from the
+    parsed sources, i.e. what the data_analysis scripts would pickle. """
+
+    ## Births and coverage, interpolated to the
+    ## semi-monthly time axis
+    annual_births = Births.births_series(sources["population"],sources["birthrate"],countries)
+    coverage = {k.lower():RI.semi_monthly_coverage(v.fillna(0))
+                for k, v in sources["coverage"].items()}
+
+    ## Put it all together
+    series = {"cases":sources["cases"],
+              "mcv1":coverage["mcv1"],
+              "mcv2":coverage["mcv2"],
+              "births":Births.semi_monthly_births(annual_births),
+              "target_pop":SIACalendar.GetTargetPopSeries(sources["sia_calendar"],countries)}
+    return series
+
+def IngestModelingDataset(root,countries,end="2023-12-31",fillna=True,max_workers=None):
+
+    """ Read the raw sources concurrently and assemble the modeling dataset in memory.
+    Returns the (country, time) dataframe, as from GetCombinedDataset, and the timing for
+    each stage. """
+
+    sources, timings = ReadSources(root,countries,max_workers)
+    tic = timer.time()
+    df = CombineSeries(AssembleSeries(sources,countries),fillna=fillna)
+    df = df.loc(axis=0)[:,:end]
+    timings["assembly"] = timer.time()-tic
+    return df, timings
+
+if __name__ == "__main__":
+
+    ## Read, assemble, and serialize
+    tic = timer.time()
+    df, timings = IngestModelingDataset(os.path.join("..","data"),countries)
+    WriteModelingDataset(df,os.path.join("..","outputs","modeling_dataset"))
+    print(df)
+
+    ## Report the timings
+    print("\nTime by stage (the sources are read concurrently):")
+    print(timings.round(2).to_string())
+    print("Total: {:.2f} seconds".format(timer.time()-tic))
@@ -6,12 +6,17 @@ and visualize data from particular countries. """
 import os
 
 ## Standard imports
+import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
 
 ## Visualization tools
 from utils.vis import *
 
+## Dense panel and memory-mapped dataset storage
+from utils.panel import Panel
+from utils.dataset import WriteModelingDataset
+
 def GetCombinedDataset(serial_box=None,fillna=True):
 
     """ Function to concetate timeseries and make a single space-time
@@ -30,23 +35,35 @@ def GetCombinedDataset(serial_box=None,fillna=True):
         assert set(serial_box.keys()) >= {"cases","mcv1","target_pop","births"},\
                "Must specify pickles for cases, mcv1, and births."
 
-    ## Use the filepaths to create a combined dataframe
-    df = pd.concat([pd.read_pickle(v).rename(k) for k,v in serial_box.items()],
-                   axis=1)
+    return CombineSeries({k:pd.read_pickle(v) for k,v in serial_box.items()},fillna=fillna)
+
+def CombineSeries(series,fillna=True):
+
+    """ The in-memory part of GetCombinedDataset, for a dictionary of (country, time)
+    series keyed by column name. """
+
+    ## Create a combined panel, aligned on the shared
+    ## semi-monthly time axis
+    panel = Panel.from_series(series)
 
     ## Compute RI adjusted births
-    if "mcv2" in df.columns:
-        df["adj_births"] = df["births"]*(1.-0.9*df["mcv1"]*(1.-df["mcv2"])\
-                                         -0.99*df["mcv1"]*df["mcv2"])
+    if "mcv2" in panel.variables:
+        adj_births = panel["births"]*(1.-0.9*panel["mcv1"]*(1.-panel["mcv2"])\
+                                      -0.99*panel["mcv1"]*panel["mcv2"])
     else:
-        df["adj_births"] = df["births"]*(1.-0.9*df["mcv1"])
+        adj_births = panel["births"]*(1.-0.9*panel["mcv1"])
+    panel = panel.assign("adj_births",adj_births,
+                         present=panel.present.any(axis=2))
 
+    rows = None
     if fillna:
-        df = df.loc[df["cases"].notnull()]
-        df["adj_births"] = df["adj_births"].groupby("country").apply(\
-                                            lambda s: s.fillna(method="ffill").fillna(method="bfill"))
+        rows = np.isfinite(panel["cases"])
+        filled = panel.ffill(where=rows).bfill(where=rows)
+        panel = panel.assign("adj_births",filled["adj_births"],
+                             present=panel.present[:,:,-1])
 
-    return df[["cases","adj_births","target_pop","mcv1","mcv2","births"]]
+    return panel.to_frame(["cases","adj_births","target_pop","mcv1","mcv2","births"],
+                          where=rows)
 
 if __name__ == "__main__":
 
@@ -54,7 +71,7 @@ if __name__ == "__main__":
     ## serialize
     df = GetCombinedDataset()
     df = df.loc(axis=0)[:,:"2023-12-31"]
-    df.to_pickle(os.path.join("..","outputs","modeling_dataset.pkl"))
+    WriteModelingDataset(df,os.path.join("..","outputs","modeling_dataset"))
     print(df)
 
     ## Make a simple plot
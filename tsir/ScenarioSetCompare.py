@@ -4,6 +4,7 @@ Fit a basic TSIR model and extrapolate under different scenarios (i.e. campaign
 RI increases and decreases, etc.). """
 
 import os
+import sys
 
 ## Standard imports
 import numpy as np
@@ -11,6 +12,7 @@ import pandas as pd
 
 ## TSIR model functions
 import utils.tsir as tsir
+from utils.dataset import ModelingDataset
 
 ## For R2 scores
 from sklearn.metrics import r2_score
@@ -80,11 +82,11 @@ def ComputeBurdenEstimate(I_samples,time,start_time,end_time):
 
 if __name__ == "__main__":
 
-    ## Get the dataset
-    country = "chad"
-    df = pd.read_pickle(os.path.join("..","outputs","modeling_dataset.pkl"))
-    df = df.loc[country]
-    df = df.loc["2014-01-01":]
+    ## Get the dataset, for the country given on the
+    ## command line (chad by default)
+    country = sys.argv[1] if len(sys.argv) > 1 else "chad"
+    dataset = ModelingDataset(os.path.join("..","outputs","modeling_dataset"))
+    df = dataset.frame(country,start="2014-01-01")
 
     ## Print the dataset
     print("\nInput dataset for {}".format(country.title()))
@@ -10,13 +10,14 @@ import pandas as pd
 
 ## TSIR model functions
 import utils.tsir as tsir
+from utils.dataset import ModelingDataset
 
 if __name__ == "__main__":
 
     ## Get the dataset
     countries = ["kenya","chad","ethiopia","nigeria","pakistan"]
-    dataset = pd.read_pickle(os.path.join("..","outputs","modeling_dataset.pkl"))
-    df = dataset.loc(axis=0)[countries,"2012-01-01":]
+    dataset = ModelingDataset(os.path.join("..","outputs","modeling_dataset"))
+    df = dataset.stack(countries,start="2012-01-01")
     
     ## Print the dataset
     print("\nDataset for analysis:")
@@ -27,7 +28,7 @@ if __name__ == "__main__":
     print("\nLooping over countries...")
     seasonality_profiles = {}
     for country in countries:
-        sf = df.loc[country].copy()
+        sf = dataset.frame(country,start="2012-01-01")
         print("Fitting the model for {}...".format(country.title()))
         sf, model, rr = tsir.FitTSIRModel(sf,
                                          tsir.BasicSusceptibleReconstruction,
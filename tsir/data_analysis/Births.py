@@ -12,6 +12,8 @@ import matplotlib.pyplot as plt
 ## Import the set of gavi countries
 sys.path.append(os.path.join(".."))
 from utils.gavi_countries import countries
+from utils.countries import CountryCodes, CountryNames
+from utils.panel import Panel
 
 ## Internal helper functions
 def get_raw_spreadsheet(root,fname,
@@ -27,25 +29,17 @@ def get_raw_spreadsheet(root,fname,
                      usecols=columns,
                      dtype=dtypes)
 
-    ## Adjust country names to the WHO spreadsheet values
-    ## done manually here.
-    adjustments = {"Yemen, Rep.":"yemen",
-                   "Vietnam":"viet nam",
-                   "Tanzania":"united republic of tanzania",
-                   "Korea, Dem. People’s Rep.":"democratic people's republic of korea",
-                   "Gambia, The":"gambia",
-                   "Congo, Dem. Rep.":"democratic republic of the congo"}
-    df["Country Name"] = df["Country Name"].apply(lambda x: adjustments.get(x,x))
-
-    ## Basic formatting
+    ## Basic formatting, with country names harmonized to the
+    ## WHO spreadsheet values by the shared registry.
     df.columns = [c.lower().replace(" name","") for c in df.columns]
-    df["country"] = df["country"].str.lower()
+    df.insert(0,"code",CountryCodes(df["country"]))
+    df["country"] = CountryNames(df["code"])
 
     return df
 
 def to_spacetime(df,name):
-    df = df.set_index("country").stack(dropna=False).reset_index()
-    df.columns = ["country","year",name]
+    df = df.drop(columns="country").set_index("code").stack(dropna=False).reset_index()
+    df.columns = ["code","year",name]
     return df
 
 def GetBirthsSeries(root,
@@ -62,11 +56,18 @@ def GetBirthsSeries(root,
                                      years=years)
     birthrate = get_raw_spreadsheet(root,fname="worldbank_crudebirthrate"+suffix+".csv",
                                     years=years)
+    return births_series(population,birthrate,countries)
+
+def births_series(population,birthrate,countries=None):
+
+    """ The annual (country, time) births series from the raw population and
+    crude birth rate spreadsheets. """
 
     ## Subset to specific countries
     if countries is not None:
-        population = population.loc[population["country"].isin(countries)]
-        birthrate = birthrate.loc[birthrate["country"].isin(countries)]
+        codes = CountryCodes(list(countries))
+        population = population.loc[np.isin(population["code"],codes)]
+        birthrate = birthrate.loc[np.isin(birthrate["code"],codes)]
 
     ## Reshape both into space-time series
     population = to_spacetime(population,"population")
@@ -80,13 +81,21 @@ def GetBirthsSeries(root,
                                         "month":6,
                                         "day":15})
 
-    ## Create a births series
-    population = population.set_index(["country","time"])["population"]
-    birthrate = birthrate.set_index(["country","time"])["br"]
+    ## Create a births series, joining on the country codes
+    population = population.set_index(["code","time"])["population"]
+    birthrate = birthrate.set_index(["code","time"])["br"]
     births = (population*birthrate/1000).rename("births")
+    births.index = pd.MultiIndex.from_arrays([CountryNames(births.index.get_level_values(0)),
+                                              births.index.get_level_values(1)],
+                                             names=["country","time"])
     
     return births
 
+def semi_monthly_births(annual_births):
+    """ Births per semi-monthly period, interpolated from the annual series. """
+    births = Panel.from_series({"births":annual_births/24}).interpolate()
+    return births.to_series("births")
+
 if __name__ == "__main__":
 
     ## Get the data
@@ -97,8 +106,7 @@ if __name__ == "__main__":
 
     ## Interpolate the date after resampling
     ## to the appropriate timescale
-    interpolation = lambda s: (s.loc[s.name]/24).resample("SM").interpolate()
-    births = annual_births.groupby("country").apply(interpolation)
+    births = semi_monthly_births(annual_births)
 
     ## Serialize the result
     births.to_pickle(os.path.join("..","..","outputs","births.pkl"))
@@ -12,40 +12,37 @@ import matplotlib.pyplot as plt
 ## Import the set of gavi countries
 sys.path.append(os.path.join(".."))
 from utils.gavi_countries import countries
+from utils.countries import CountryCodes, CountryNames
+from utils.panel import Panel
+
+## Shared WHO case data reader, at the top of the repo
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),"..",".."))
+from who_cases import MONTHS, read_case_table, month_end_times
 
 ## Internal helper functions
 def get_raw_spreadsheet(root,
                         fname="measlescasesbycountrybymonth_Mar2024.csv"):
 
-    ## I/O based on pandas with specific dtypes
-    ## for speed.
-    columns = ["Country","Year",
-               "January","February","March","April",
-               "May","June","July","August","September",
-               "October","November","December"]
-    dtypes = {c:np.float64 for c in columns[2:]}
-    dtypes["Country"] = str
-    dtypes["Year"] = np.int32
-
-    ## Get the CSV
-    df = pd.read_csv(os.path.join(root,fname),
-                    header=0,
-                    usecols=columns,
-                    dtype=dtypes)
-
-    ## Basic formatting
-    df.columns = [c.lower() for c in df.columns]
-    df["country"] = df["country"].str.lower()
+    ## I/O via the shared, cached reader, which skips
+    ## the CSV parse when the cache is current.
+    table = read_case_table(os.path.join(root,fname))
+    df = pd.DataFrame(table["cases"],columns=[m.lower() for m in MONTHS])
+    df.insert(0,"year",table["year"].astype(np.int32))
+
+    ## Registry codes for the table's countries, then for each row
+    codes = CountryCodes(table["countries"])[table["code"]]
+    df.insert(0,"code",codes)
+    df.insert(0,"country",CountryNames(codes))
 
     return df
 
 def semi_monthly_resample(df):
-    resample_func = lambda s: s.loc[s.name].resample("SM").asfreq()
-    return df.groupby("country").apply(resample_func)
+    panel = Panel.from_series({"cases":df}).span()
+    return panel.to_series("cases")
 
 def semi_monthly_smooth(df,w=3):
-    smooth_func = lambda s: (s.loc[s.name]/2.).resample("SM").bfill().rolling(w).mean()
-    return df.groupby("country").apply(smooth_func)
+    panel = Panel.from_series({"cases":df/2.}).span().bfill().rolling_mean(w)
+    return panel.to_series("cases")
 
 ## Subroutine for data retrieval and processing.
 def GetEpiCurveSeries(root,
@@ -61,21 +58,20 @@ def GetEpiCurveSeries(root,
 
     ## Subset to country set if specified
     if countries is not None:
-        df = df.loc[df["country"].isin(countries)]
+        df = df.loc[np.isin(df["code"],CountryCodes(list(countries)))]
 
     ## Reshape so the individual month columns are stacked
-    ## into a single column
-    df = df.set_index(["country","year"]).stack(dropna=True).reset_index()
-    df.columns = ["country","year","month","cases"]
-
-    ## Create a time series for each row, with date set to the
-    ## end of the month.
-    df["time"] = pd.to_datetime(df["year"].astype(str)+df["month"],
-                                format="%Y%B")
-    df["time"] = df["time"].dt.to_period("M").dt.to_timestamp("M")
+    ## into a single column, with the date for each entry set
+    ## to the end of the month.
+    cases = df[[m.lower() for m in MONTHS]].values
+    time = month_end_times(df["year"].values)
+    observed = np.isfinite(cases)
+    df = pd.DataFrame({"country":np.repeat(df["country"].values,12)[observed.reshape(-1)],
+                       "time":time[observed],
+                       "cases":cases[observed]})
 
     ## Finally, clean up
-    df = df[["country","time","cases"]].set_index(["country","time"])["cases"]
+    df = df.set_index(["country","time"])["cases"]
 
     ## And if needed, resample and smooth
     if sm_smooth:
@@ -12,68 +12,92 @@ import matplotlib.pyplot as plt
 ## Import the set of gavi countries
 sys.path.append(os.path.join(".."))
 from utils.gavi_countries import countries
+from utils.countries import CountryCodes, CountryNames
+from utils.panel import Panel
 
-def get_raw_spreadsheet(vaccine,root,
-                        fname="coverage_estimates_series.xls",
-                        years=(2010,2019)):
+## The WUENIC estimates, as opposed to administrative or official coverage
+WUENIC = "WHO/UNICEF Estimates of National Immunization Coverage"
 
-    ## Updated WHEUNIC estimates have a new format, so we have
-    ## two different I/O patterns implemente
-    dtypes = {"NAME":str,
-              "YEAR":str,
-              "ANTIGEN":str,
-              "COVERAGE_CATEGORY_DESCRIPTION":str,
+def read_coverage_rows(vaccines,root,
+                       fname="coverage_estimates_Aug2023.csv",
+                       chunksize=2**14):
+
+    """ Scan the WUENIC file once, in chunks, keeping only the estimate rows for the
+    requested vaccines (antigens). The repeated string columns are read as categoricals,
+    so filtering each chunk is a cheap code comparison, and requesting more antigens costs
+    nothing beyond the rows kept. """
+
+    dtypes = {"NAME":"category",
+              "YEAR":np.float64,
+              "ANTIGEN":"category",
+              "COVERAGE_CATEGORY_DESCRIPTION":"category",
               "COVERAGE":np.float64}
-    columns = list(dtypes.keys())
-    df = pd.read_csv(os.path.join(root,fname),
-                       header=0,
-                       usecols=columns,
-                       dtype=dtypes,
-                       )
-
-    ## Subset and reshape
-    df = df.loc[(df["ANTIGEN"] == vaccine) & \
-                (df["COVERAGE_CATEGORY_DESCRIPTION"] == \
-                "WHO/UNICEF Estimates of National Immunization Coverage")]
+    chunks = pd.read_csv(os.path.join(root,fname),
+                         header=0,
+                         usecols=list(dtypes.keys()),
+                         dtype=dtypes,
+                         chunksize=chunksize,
+                         )
+    rows = []
+    for chunk in chunks:
+        keep = (chunk["COVERAGE_CATEGORY_DESCRIPTION"] == WUENIC) & \
+               (chunk["ANTIGEN"].isin(vaccines))
+        rows.append(chunk.loc[keep,["NAME","YEAR","ANTIGEN","COVERAGE"]].astype({"NAME":str,
+                                                                               "ANTIGEN":str}))
+    df = pd.concat(rows,axis=0,ignore_index=True)
     df["YEAR"] = df["YEAR"].astype(np.int32)
-
-    ## Adjust country names to the WHO spreadsheet values
-    ## done manually here.
-    adjustments = {"Democratic People's Republic of Korea (the)":"democratic people's republic of korea",
-                   "Democratic Republic of the Congo (the)":"democratic republic of the congo",
-                   "occupied Palestinian territory, including east Jerusalem":"palestine"}
-    df["NAME"] = df["NAME"].apply(lambda x: adjustments.get(x,x))
-
-    ## Pivot into the data structure for interpolation
-    df = df[["NAME","YEAR","COVERAGE"]].pivot(index="NAME",
-                                              columns="YEAR",
-                                              values="COVERAGE")
-    df = df.reset_index().rename(columns={"NAME":"country"})
-
-    ## Subset to relevant years, do some simple formating
-    df = df[["country"]+list(range(*years))].copy()
-    df["country"] = df["country"].str.lower()
-    df.columns.name = None
-        
     return df
 
-def GetCoverageSeries(vaccine,root,
-                      fname="coverage_estimates_series.xls",
-                      years=(2010,2019),
-                      countries=None):
+def get_raw_spreadsheets(vaccines,root,
+                         fname="coverage_estimates_series.xls",
+                         years=(2010,2019)):
 
-    """ Subroutine to create coverage timeseries. Vaccine corresponds to
-    a sheet in the WUENIC dataset. """
+    """ Country by year coverage tables for each vaccine in vaccines, from a single
+    pass over the file. Returns a dictionary keyed by vaccine. """
+
+    ## Get the estimates for all the vaccines at once
+    df = read_coverage_rows(vaccines,root,fname)
+
+    ## Map country names to registry codes, harmonizing the
+    ## spellings with the WHO spreadsheet values.
+    df["code"] = CountryCodes(df["NAME"])
+
+    ## Pivot each vaccine into the data structure for interpolation
+    tables = {}
+    for vaccine, vdf in df.groupby("ANTIGEN"):
+        vdf = vdf[["code","YEAR","COVERAGE"]].pivot(index="code",
+                                                    columns="YEAR",
+                                                    values="COVERAGE")
+
+        ## Subset to relevant years, do some simple formating
+        vdf = vdf[list(range(*years))].reset_index()
+        vdf.insert(0,"country",CountryNames(vdf["code"]))
+        vdf.columns.name = None
+        tables[vaccine] = vdf
+
+    ## Make sure everything requested was found
+    missing = [v for v in vaccines if v not in tables]
+    if missing:
+        raise ValueError("No WUENIC estimates for {} in {}.".format(missing,fname))
+
+    return tables
+
+def get_raw_spreadsheet(vaccine,root,
+                        fname="coverage_estimates_series.xls",
+                        years=(2010,2019)):
+    return get_raw_spreadsheets([vaccine],root,fname,years)[vaccine]
+
+def coverage_series(df,vaccine,countries=None):
+
+    """ Reshape a country by year coverage table into a (country, time)
+    timeseries, scaled to a fraction. """
 
-    ## Get the raw data
-    df = get_raw_spreadsheet(vaccine,root,fname,years)
-    
     ## Subset to specific countries
     if countries is not None:
-        df = df.loc[df["country"].isin(countries)]
+        df = df.loc[np.isin(df["code"],CountryCodes(list(countries)))]
 
     ## Reshape to spacetime df
-    df = df.set_index("country").stack(dropna=False).reset_index()
+    df = df.drop(columns="code").set_index("country").stack(dropna=False).reset_index()
     df.columns = ["country","year",vaccine.lower()]
 
     ## Convert to timestamps
@@ -86,24 +110,54 @@ def GetCoverageSeries(vaccine,root,
 
     return df
 
+def GetCoverageSeries(vaccine,root,
+                      fname="coverage_estimates_series.xls",
+                      years=(2010,2019),
+                      countries=None):
 
-if __name__ == "__main__":
+    """ Subroutine to create coverage timeseries. Vaccine corresponds to
+    a sheet in the WUENIC dataset. """
 
-    for coverage_name in ["MCV1", "MCV2"]:
+    ## Get the raw data
+    df = get_raw_spreadsheet(vaccine,root,fname,years)
+    return coverage_series(df,vaccine,countries)
+
+def GetCoverageSeriesSet(vaccines,root,
+                         fname="coverage_estimates_series.xls",
+                         years=(2010,2019),
+                         countries=None):
+
+    """ Coverage timeseries for a set of vaccines, e.g. ["MCV1","MCV2","DTP3"],
+    from a single pass over the WUENIC file. Returns a dictionary keyed by vaccine. """
+
+    tables = get_raw_spreadsheets(vaccines,root,fname,years)
+    return {v:coverage_series(tables[v],v,countries) for v in vaccines}
 
-        ## Get the data
-        annual_coverage = GetCoverageSeries(coverage_name,os.path.join("..","..","data"),
+def semi_monthly_coverage(annual_coverage):
+    """ Coverage interpolated to the semi-monthly time axis. Missing values should be
+    filled first, e.g. with 0 before MCV2 introduction. """
+    name = annual_coverage.name
+    coverage = Panel.from_series({name:annual_coverage}).interpolate()
+    return coverage.to_series(name)
+
+if __name__ == "__main__":
+
+    ## Get the data, for every antigen in one pass
+    vaccines = ["MCV1", "MCV2"]
+    annual_coverages = GetCoverageSeriesSet(vaccines,os.path.join("..","..","data"),
                                             fname="coverage_estimates_Aug2023.csv",
                                             countries=countries,
                                             years=(2009,2023))
-        
+
+    for coverage_name in vaccines:
+        annual_coverage = annual_coverages[coverage_name]
+
         ## NaNs here are places without vaccine (MCV2) introduction
         annual_coverage = annual_coverage.fillna(0)
 
         ## Interpolate the date after resampling
         ## to the appropriate timescale
-        interpolation = lambda s: s.loc[s.name].resample("SM").interpolate()
-        coverage = annual_coverage.groupby("country").apply(interpolation)
+        coverage = semi_monthly_coverage(annual_coverage)
 
         ## Serialize the result
         coverage.to_pickle(os.path.join("..","..","outputs","{}.pkl".format(coverage.name)))
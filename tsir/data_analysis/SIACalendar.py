@@ -11,11 +11,53 @@ import pandas as pd
 ## construction.
 sys.path.append(os.path.join(".."))
 from utils.gavi_countries import countries
+from utils.countries import CountryCodes, CountryNames
 
-if __name__ == "__main__":
+def build_target_pop(sia_calendar,countries,time_index):
 
-    ## Process the SIA calendar
-    sia_calendar = pd.read_csv(os.path.join("..","..","data","Summary_MR_SIA.csv"),
+    """ Place the SIAs in sia_calendar (with country, time, and target_pop columns) on a
+    (country, time) grid, returning a series over the product of countries and time_index.
+    Each SIA goes to the time nearest its start date (we use the start date since a lot of the
+    entries in the dataset have no end date), for the country with the same registry code, and
+    later SIAs overwrite earlier ones. As with np.argmin in the original loop, SIAs without a
+    start date land on the last time.
+
+    Times are snapped with searchsorted and countries are matched by code, so everything is
+    filled in with a single scatter. """
+
+    ## Snap to the nearest time, breaking ties towards the
+    ## earlier time.
+    t = pd.DatetimeIndex(sia_calendar["time"])
+    grid = time_index.values
+    j = np.clip(np.searchsorted(grid,t.values),1,len(grid)-1)
+    earlier = (t.values-grid[j-1]) <= (grid[j]-t.values)
+    time_pos = np.where(earlier,j-1,j)
+    time_pos[t.values < grid[0]] = 0
+    time_pos[np.isnat(t.values)] = len(grid)-1
+
+    ## Join SIAs to countries on the registry codes, dropping
+    ## SIAs in countries off the grid.
+    countries = np.asarray(countries,dtype=object)
+    country_pos = pd.Index(CountryCodes(countries)).get_indexer(CountryCodes(sia_calendar["country"]))
+    sia = np.flatnonzero(country_pos >= 0)
+    flat = country_pos[sia]*len(grid)+time_pos[sia]
+
+    ## Scatter, keeping the last SIA at each entry
+    _, last = np.unique(flat[::-1],return_index=True)
+    last = len(flat)-1-last
+    target_pop = np.zeros((len(countries)*len(grid),))
+    target_pop[flat[last]] = sia_calendar["target_pop"].values[sia[last]]
+
+    index = pd.MultiIndex.from_product([countries,time_index],
+                                        names=["country","time"])
+    return pd.Series(target_pop,index=index,name="target_pop")
+
+def get_raw_spreadsheet(root,fname="Summary_MR_SIA.csv"):
+
+    """ The SIA calendar, with start times, doses (reached population, or target population
+    where that's missing), and registry codes for the countries. """
+
+    sia_calendar = pd.read_csv(os.path.join(root,fname),
                           header=1,
                           usecols=["Country","Start date","End date",
                                     "Target population","Reached population"],
@@ -28,43 +70,38 @@ if __name__ == "__main__":
     sia_calendar["doses"] = sia_calendar["doses"].fillna(
         pd.to_numeric(sia_calendar["Target population"]\
                                     .str.replace(" ","")))
-    sia_calendar["country"] = sia_calendar["Country"].str.lower()
+    sia_calendar["code"] = CountryCodes(sia_calendar["Country"])
+    sia_calendar["country"] = CountryNames(sia_calendar["code"])
+    return sia_calendar
+
+def GetTargetPopSeries(sia_calendar,countries,
+                       start="2008-12-31",end="2023-12-31"):
+
+    """ Subroutine to estimate each SIA's target population by its share of the country's
+    largest campaign, placed on the semi-monthly (country, time) grid. """
 
     ## Get the list of countries
     countries = sorted(list(countries))
     
     ## Estimate target population by dose distribution
-    sia_calendar = sia_calendar.loc[sia_calendar["country"].isin(countries)]
+    sia_calendar = sia_calendar.loc[np.isin(sia_calendar["code"],CountryCodes(countries))].copy()
 
-    max_doses = sia_calendar[["country","doses"]].groupby("country").max()["doses"]
+    max_doses = sia_calendar[["code","doses"]].groupby("code").max()["doses"]
     sia_calendar["target_pop"] = sia_calendar["doses"]/\
-            (max_doses.loc[sia_calendar["country"]].values)
+            (max_doses.loc[sia_calendar["code"]].values)
     sia_calendar["target_pop"] = sia_calendar["target_pop"].fillna(0)
     
     ## Create multiindex series with the appropriate shape
-    time_index = pd.date_range(start="2008-12-31",
-                               end="2023-12-31",
+    time_index = pd.date_range(start=start,
+                               end=end,
                                freq="SM")
-    index = pd.MultiIndex.from_product([countries,time_index],
-                                        names=["country","time"])
-    target_pop = pd.Series(np.zeros((len(index),)),
-                           index=index,
-                           name="target_pop")
-
-    ## Loop over SIAs and fill in the data at the
-    ## desired admin level
-    for i, sia in sia_calendar.iterrows():
-
-        ## Start by getting the closest time to the intended
-        ## time index. We use the start date since a lot of the
-        ## entries in the dataset have no end date.
-        sia_time = time_index[np.argmin(np.abs(time_index-sia.loc["time"]))]
+    return build_target_pop(sia_calendar,countries,time_index)
 
-        ## Get the appropriate rows
-        rows = [(c, sia_time) for c in countries if c.startswith(sia.loc["country"])]
+if __name__ == "__main__":
 
-        ## Set the values
-        target_pop.loc[rows] = sia.loc["target_pop"]
+    ## Process the SIA calendar
+    sia_calendar = get_raw_spreadsheet(os.path.join("..","..","data"))
+    target_pop = GetTargetPopSeries(sia_calendar,countries)
 
     ## Serialize the result
     target_pop.to_pickle(os.path.join("..","..","outputs","target_pop.pkl"))
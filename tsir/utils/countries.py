@@ -0,0 +1,132 @@
+""" countries.py
+
+A single registry of country names for the tsir data pipeline. Names are harmonized to the
+lowercase WHO spreadsheet spellings, as in gavi_countries.py, and every canonical name gets an
+integer code. Spellings from the World Bank and WUENIC files are mapped through one alias
+table, so the readers can translate a whole column of names to codes at once and join on the
+codes instead of comparing strings.
+
+Codes for the gavi countries (in sorted order) and the alias targets are fixed. Any other name
+is added to the registry the first time it's looked up, with a code derived from a hash of its
+canonical spelling, so codes are the same in every run, thread, and process, whatever order
+the names are looked up in. """
+
+import hashlib
+import threading
+
+## Standard imports
+import numpy as np
+import pandas as pd
+
+## The seed set
+from utils.gavi_countries import countries as gavi_countries
+
+## Other spellings, keyed by their lowercase form, mapped to the
+## canonical (WHO) name. World Bank names first, then WUENIC.
+ALIASES = {"bahamas, the":"bahamas",
+           "bolivia":"bolivia (plurinational state of)",
+           "cote d'ivoire":"côte d'ivoire",
+           "congo, dem. rep.":"democratic republic of the congo",
+           "congo, rep.":"congo",
+           "egypt, arab rep.":"egypt",
+           "gambia, the":"gambia",
+           "iran, islamic rep.":"iran (islamic republic of)",
+           "korea, dem. people's rep.":"democratic people's republic of korea",
+           "korea, dem. people’s rep.":"democratic people's republic of korea",
+           "korea, rep.":"republic of korea",
+           "kyrgyz republic":"kyrgyzstan",
+           "lao pdr":"lao people's democratic republic",
+           "micronesia, fed. sts.":"micronesia (federated states of)",
+           "moldova":"republic of moldova",
+           "netherlands":"netherlands (kingdom of the)",
+           "slovak republic":"slovakia",
+           "st. kitts and nevis":"saint kitts and nevis",
+           "st. lucia":"saint lucia",
+           "st. vincent and the grenadines":"saint vincent and the grenadines",
+           "tanzania":"united republic of tanzania",
+           "turkiye":"türkiye",
+           "united kingdom":"united kingdom of great britain and northern ireland",
+           "united states":"united states of america",
+           "venezuela, rb":"venezuela (bolivarian republic of)",
+           "vietnam":"viet nam",
+           "yemen, rep.":"yemen",
+           "democratic people's republic of korea (the)":"democratic people's republic of korea",
+           "democratic republic of the congo (the)":"democratic republic of the congo",
+           "occupied palestinian territory, including east jerusalem":"palestine",
+           }
+
+## Codes derived from names start here, past any seed set.
+FIRST_HASHED_CODE = 2**16
+
+def name_code(name):
+    """ The code for a name outside the seed set, from the SHA-256 of its spelling. """
+    digest = hashlib.sha256(name.encode("utf-8")).digest()
+    return FIRST_HASHED_CODE + int.from_bytes(digest[:4],"little") % (2**31-FIRST_HASHED_CODE)
+
+class CountryRegistry:
+
+    """ Canonical country names and their integer codes. The lookups work on the unique
+    names in the input, so the string handling is done once per country rather than once
+    per row. The seed names get codes 0, 1, 2, etc. in order, and names added later get
+    codes from name_code. Extending the registry is locked, so readers in different threads
+    can share it. """
+
+    def __init__(self,names,aliases=ALIASES):
+        self.aliases = dict(aliases)
+        self._lock = threading.Lock()
+        self.index = pd.Index(list(names),dtype=object,name="country")
+        if not self.index.is_unique:
+            raise ValueError("Canonical country names have to be unique.")
+        if len(self.index) > FIRST_HASHED_CODE:
+            raise ValueError("The seed set can have at most {} names.".format(FIRST_HASHED_CODE))
+        self.code_index = pd.Index(np.arange(len(self.index),dtype=np.int64),name="code")
+
+    def __len__(self):
+        return len(self.index)
+
+    def canonical(self,names):
+        """ The canonical spelling for each name in an array of unique names. """
+        lower = pd.Index(names,dtype=object).str.strip().str.lower()
+        return np.array([self.aliases.get(n,n) for n in lower],dtype=object)
+
+    def codes(self,names,extend=True):
+        """ Integer codes for an array-like of names, with -1 for missing names. Names that
+        aren't in the registry are added if extend, and otherwise get -1 as well. """
+        row_codes, uniques = pd.factorize(np.asarray(names,dtype=object))
+        canonical = self.canonical(uniques)
+        positions = self.index.get_indexer(canonical)
+        if extend and (positions < 0).any():
+            with self._lock:
+                positions = self.index.get_indexer(canonical)
+                new = pd.unique(canonical[positions < 0])
+                new_codes = pd.Index([name_code(n) for n in new],dtype=np.int64,name="code")
+                if new_codes.has_duplicates or self.code_index.isin(new_codes).any():
+                    raise ValueError("Hashed codes for {} collide.".format(list(new)))
+                self.index = self.index.append(pd.Index(new,dtype=object,name="country"))
+                self.code_index = self.code_index.append(new_codes)
+                positions = self.index.get_indexer(canonical)
+
+        ## Missing names have row code -1 from factorize, which
+        ## picks out the appended -1.
+        unique_codes = np.where(positions < 0,-1,self.code_index.values[positions])
+        unique_codes = np.append(unique_codes,-1)
+        return unique_codes[row_codes]
+
+    def names(self,codes):
+        """ Canonical names for an array of codes, with NaN for codes that aren't in the
+        registry. """
+        positions = self.code_index.get_indexer(np.asarray(codes,dtype=np.int64).reshape(-1))
+        names = np.append(self.index.values,np.nan)[positions]
+        return names.reshape(np.shape(codes))
+
+## The shared registry, with the gavi countries first
+registry = CountryRegistry(sorted(gavi_countries)\
+                           +sorted(set(ALIASES.values())-set(gavi_countries)))
+
+def CountryCodes(names,extend=True):
+    """ Codes from the shared registry, see CountryRegistry.codes. """
+    return registry.codes(names,extend=extend)
+
+def CountryNames(codes):
+    """ Canonical names from the shared registry. """
+    return registry.names(codes)
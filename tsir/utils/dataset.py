@@ -0,0 +1,101 @@
+""" dataset.py
+
+Array-backed, memory-mapped storage for the (country, time) modeling dataset from
+PrepareModelingDataset.py. Each variable is one contiguous float64 .npy file with the countries'
+rows stored back to back, so a country is a slice described by an offset index, and every row
+points into a single shared time axis. Opening the store only reads the small index arrays, and
+the variables are memory-mapped, so slicing a country is zero-copy and worker processes reading
+the same store share the operating system's page cache rather than holding copies. """
+import os
+
+## Standard imports
+import numpy as np
+import pandas as pd
+
+def WriteModelingDataset(df,path):
+
+    """ Serialize a dataframe with a (country, time) multi-index, as from
+    GetCombinedDataset, into a directory of arrays at path. """
+
+    os.makedirs(path,exist_ok=True)
+
+    ## Group rows by country, in the order of first appearance,
+    ## keeping the time order within each country.
+    country = df.index.get_level_values(0)
+    codes, countries = pd.factorize(country)
+    order = np.argsort(codes,kind="stable")
+    offsets = np.concatenate([[0],np.cumsum(np.bincount(codes,minlength=len(countries)))])
+
+    ## The shared time axis and each row's position on it
+    times = df.index.get_level_values(1)[order]
+    time_axis = np.unique(times.values)
+    time_code = np.searchsorted(time_axis,times.values).astype(np.int32)
+
+    ## Write the index arrays, then the variables
+    np.save(os.path.join(path,"countries.npy"),np.asarray(countries,dtype=str))
+    np.save(os.path.join(path,"offsets.npy"),offsets.astype(np.int64))
+    np.save(os.path.join(path,"time.npy"),time_axis.astype("datetime64[ns]"))
+    np.save(os.path.join(path,"time_code.npy"),time_code)
+    np.save(os.path.join(path,"columns.npy"),np.asarray(df.columns,dtype=str))
+    for c in df.columns:
+        np.save(os.path.join(path,c+".npy"),
+                np.ascontiguousarray(df[c].values[order],dtype=np.float64))
+
+class ModelingDataset:
+
+    """ Read-only view of a dataset written by WriteModelingDataset. arrays() gives zero-copy
+    views of a country's variables, and frame() the familiar per-country dataframe, i.e.
+    what modeling_dataset.loc[country] used to give. Instances pickle as their path, so they
+    can be passed to worker processes cheaply. """
+
+    def __init__(self,path):
+        self.path = path
+        load = lambda name, **kwargs: np.load(os.path.join(path,name+".npy"),**kwargs)
+        self.countries = list(load("countries"))
+        self.offsets = load("offsets")
+        self.time = load("time")
+        self.time_code = load("time_code",mmap_mode="r")
+        self.columns = list(load("columns"))
+        self.variables = {c:load(c,mmap_mode="r") for c in self.columns}
+        self._index = {c:i for i,c in enumerate(self.countries)}
+
+    def __getstate__(self):
+        return {"path":self.path}
+
+    def __setstate__(self,state):
+        self.__init__(state["path"])
+
+    def __contains__(self,country):
+        return country in self._index
+
+    def rows(self,country):
+        """ The slice of rows for a country. """
+        i = self._index[country]
+        return slice(self.offsets[i],self.offsets[i+1])
+
+    def times(self,country):
+        """ A country's time stamps, a view of the shared axis if its
+        rows are contiguous in time. """
+        code = self.time_code[self.rows(country)]
+        if len(code) and (code[-1]-code[0] == len(code)-1):
+            return self.time[code[0]:code[-1]+1]
+        return self.time[code]
+
+    def arrays(self,country,columns=None):
+        """ Zero-copy (memory-mapped) views of a country's variables, by column. """
+        rows = self.rows(country)
+        columns = self.columns if columns is None else columns
+        return {c:self.variables[c][rows] for c in columns}
+
+    def frame(self,country,columns=None,start=None,end=None):
+        """ A country's data as a time-indexed dataframe, optionally restricted
+        to times between start and end (inclusive). """
+        df = pd.DataFrame(self.arrays(country,columns),
+                          index=pd.DatetimeIndex(self.times(country),name="time"))
+        return df.loc[start:end]
+
+    def stack(self,countries=None,start=None,end=None):
+        """ The (country, time) multi-index dataframe for a set of countries. """
+        countries = self.countries if countries is None else countries
+        frames = [self.frame(c,start=start,end=end) for c in countries]
+        return pd.concat(frames,keys=countries,names=["country","time"])
@@ -0,0 +1,173 @@
+""" panel.py
+
+A dense (country, time, variable) panel for the tsir data pipeline. Countries are joined on their
+codes in the shared registry (see countries.py), every variable shares a single semi-monthly
+time axis, and the data live in one 3-D array, so resampling, interpolation, and filling run as
+vectorized operations over all countries at once instead of through groupby("country").apply. """
+
+## Standard imports
+import numpy as np
+import pandas as pd
+
+## For joins on country codes
+from utils.countries import CountryCodes, CountryNames
+
+def SemiMonthlyAxis(start,end):
+    """ The semi-monthly (15th and month end) time axis from start to end. """
+    return pd.date_range(start=start,end=end,freq="SM",name="time")
+
+def _previous_valid(valid):
+    """ Index of the last valid entry at or before each position along axis 1,
+    or -1 if there isn't one. """
+    index = np.arange(valid.shape[1]).reshape((1,-1)+(valid.ndim-2)*(1,))
+    return np.maximum.accumulate(np.where(valid,index,-1),axis=1)
+
+def _next_valid(valid):
+    """ Index of the first valid entry at or after each position along axis 1,
+    or the length of the axis if there isn't one. """
+    T = valid.shape[1]
+    index = np.arange(T).reshape((1,-1)+(valid.ndim-2)*(1,))
+    nxt = np.minimum.accumulate(np.where(valid,index,T)[:,::-1],axis=1)[:,::-1]
+    return nxt
+
+def _take(values,index):
+    """ values[c,index[c,t,v],v], with out of range indices giving NaN. """
+    T = values.shape[1]
+    safe = np.clip(index,0,T-1)
+    out = np.take_along_axis(values,safe,axis=1)
+    return np.where((index >= 0) & (index < T),out,np.nan)
+
+def _span(present):
+    """ Mask of the positions between the first and last present entries,
+    along axis 1. """
+    return (_previous_valid(present) >= 0) & (_next_valid(present) < present.shape[1])
+
+class Panel:
+
+    """ values has shape (num_countries, num_times, num_variables), with NaN for missing
+    data, and present marks the (country, time, variable) entries that exist, which is what a
+    long (country, time) series would have as rows. Operations return new panels. """
+
+    def __init__(self,countries,time,variables,values,present=None):
+        self.countries = pd.Index(countries,name="country")
+        self.time = pd.DatetimeIndex(time,name="time")
+        self.variables = list(variables)
+        self.values = values
+        if present is None:
+            present = np.isfinite(values)
+        self.present = present
+
+    @classmethod
+    def from_series(cls,series,time=None,dtype=np.float64):
+
+        """ Scatter a dictionary of (country, time) multi-index series, keyed by variable
+        name, into a panel. Every time stamp has to be on the time axis, which defaults to
+        the semi-monthly axis spanning the series, and since mid-year (June 15th) and
+        month-end stamps are on that axis this is the resample("SM") step. """
+
+        ## Shared axes, with the series joined on the country
+        ## registry codes and the countries in sorted order.
+        codes = [CountryCodes(s.index.get_level_values(0)) for s in series.values()]
+        country_codes = np.unique(np.concatenate(codes))
+        country_codes = country_codes[np.argsort(CountryNames(country_codes))]
+        countries = pd.Index(CountryNames(country_codes))
+        if time is None:
+            start = min(s.index.get_level_values(1).min() for s in series.values())
+            end = max(s.index.get_level_values(1).max() for s in series.values())
+            time = SemiMonthlyAxis(start,end)
+
+        ## Scatter each series
+        shape = (len(countries),len(time),len(series))
+        values = np.full(shape,np.nan,dtype=dtype)
+        present = np.zeros(shape,dtype=bool)
+        for v, s in enumerate(series.values()):
+            c = pd.Index(country_codes).get_indexer(codes[v])
+            t = time.get_indexer(s.index.get_level_values(1))
+            if (t < 0).any():
+                raise ValueError("Time stamps in {} aren't on the time axis.".format(s.name))
+            values[c,t,v] = s.values
+            present[c,t,v] = True
+        return cls(countries,time,series.keys(),values,present)
+
+    def __getitem__(self,variable):
+        """ The (country, time) array for a variable. """
+        return self.values[:,:,self.variables.index(variable)]
+
+    def assign(self,variable,values,present=None):
+        """ A panel with a (country, time) array added (or replaced) as variable. If present
+        isn't given, the new variable exists wherever it's finite. """
+        if present is None:
+            present = np.isfinite(values)
+        keep = [v for v in self.variables if v != variable]
+        index = [self.variables.index(v) for v in keep]
+        return Panel(self.countries,self.time,keep+[variable],
+                     np.concatenate([self.values[:,:,index],values[:,:,None]],axis=2),
+                     np.concatenate([self.present[:,:,index],present[:,:,None]],axis=2))
+
+    def interpolate(self):
+        """ Linear interpolation in time over each country's span, like resample("SM")
+        .interpolate() for each country. Values after the last observation are held
+        constant and values before the first are left missing, as in pandas. """
+        span = _span(self.present)
+        valid = np.isfinite(self.values) & span
+        prev = _previous_valid(valid)
+        nxt = _next_valid(valid)
+        v0 = _take(self.values,prev)
+        v1 = _take(self.values,nxt)
+        index = np.arange(len(self.time)).reshape((1,-1,1))
+        with np.errstate(invalid="ignore",divide="ignore"):
+            weight = (index-prev)/(nxt-prev)
+        values = np.where(nxt < len(self.time),v0+weight*(v1-v0),v0)
+        values = np.where(valid,self.values,values)
+        values = np.where(span,values,np.nan).astype(self.values.dtype)
+        return Panel(self.countries,self.time,self.variables,values,span)
+
+    def ffill(self,where=None):
+        """ Forward fill in time within each country, over the (country, time) entries
+        in where (by default every present entry). """
+        return self._fill(_previous_valid,where)
+
+    def bfill(self,where=None):
+        """ Backward fill in time within each country, as with ffill. """
+        return self._fill(_next_valid,where)
+
+    def _fill(self,find,where):
+        span = self.present if where is None else (where[:,:,None] & np.ones_like(self.present))
+        valid = np.isfinite(self.values) & span
+        values = np.where(span,_take(self.values,find(valid)),np.nan).astype(self.values.dtype)
+        return Panel(self.countries,self.time,self.variables,values,self.present)
+
+    def span(self):
+        """ A panel whose present entries are extended to fill the time between each
+        country's first and last present entry (the upsampling in resample("SM")). """
+        return Panel(self.countries,self.time,self.variables,self.values,_span(self.present))
+
+    def rolling_mean(self,window):
+        """ Trailing rolling mean over time, missing if any value in the window is,
+        i.e. rolling(window).mean() within each country. """
+        values = np.where(self.present,self.values,np.nan)
+        pad = np.zeros((values.shape[0],1,values.shape[2]))
+        csum = np.concatenate([pad,np.cumsum(np.nan_to_num(values),axis=1)],axis=1)
+        cnan = np.concatenate([pad,np.cumsum(~np.isfinite(values),axis=1)],axis=1)
+        means = np.full(values.shape,np.nan,dtype=self.values.dtype)
+        sums = csum[:,window:]-csum[:,:-window]
+        nans = cnan[:,window:]-cnan[:,:-window]
+        means[:,window-1:] = np.where(nans == 0,sums/window,np.nan)
+        return Panel(self.countries,self.time,self.variables,means,self.present)
+
+    def to_frame(self,variables=None,where=None):
+        """ The long (country, time) multi-index dataframe of the entries in where,
+        by default those where any of the variables is present. """
+        variables = self.variables if variables is None else variables
+        index = [self.variables.index(v) for v in variables]
+        if where is None:
+            where = self.present[:,:,index].any(axis=2)
+        c, t = np.nonzero(where)
+        rows = pd.MultiIndex.from_arrays([self.countries[c],self.time[t]],
+                                         names=["country","time"])
+        return pd.DataFrame(self.values[c,t][:,index],index=rows,columns=variables)
+
+    def to_series(self,variable):
+        """ A single variable as a (country, time) series over its present entries. """
+        v = self.variables.index(variable)
+        return self.to_frame([variable],where=self.present[:,:,v])[variable]
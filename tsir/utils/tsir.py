@@ -12,7 +12,7 @@ import pandas as pd
 from sklearn.metrics import r2_score
 
 ## For optimization
-from scipy.optimize import minimize
+from scipy.optimize import minimize, approx_fprime
 
 ## Helper functions
 def up_sample(x):
@@ -22,71 +22,119 @@ def up_sample(x):
                       index=["adj_births","cases","target_pop"])
     return series
 
+def sia_adjusted_cumsum(b,sia_c):
+
+    """ The SIA-adjusted cumulative sum, y[0] = b[0] and y[k] = sia_c[k-1]*(y[k-1] + b[k]),
+    i.e. a running total that's depleted by a factor of 1-sia at each SIA. This is the product
+    of b with the (n x n) matrix of cumulative products of sia_c used in the reconstruction,
+    computed in O(n) without forming it. b and sia_c have time on the first axis and can carry
+    matching (or broadcasting) trailing axes for many series at once.
+
+    Away from SIAs, sia_c = 1 and this is just a cumulative sum, so we scan segment by
+    segment, with one np.cumsum per interval between SIAs. """
+
+    b = np.asarray(b,dtype=np.float64)
+    sia_c = np.asarray(sia_c,dtype=np.float64)
+    y = np.array(np.broadcast_to(b,np.broadcast(b,sia_c).shape))
+
+    ## Segments start after every step with an SIA
+    sia_steps = (sia_c[:-1] != 1.).reshape((len(sia_c)-1,-1)).any(axis=1)
+    starts = np.concatenate([[0],np.flatnonzero(sia_steps)+1])
+    ends = np.append(starts[1:],len(y))
+    for s, e in zip(starts,ends):
+        if s > 0:
+            y[s] = sia_c[s-1]*(y[s-1]+y[s])
+        y[s:e] = np.cumsum(y[s:e],axis=0)
+    return y
+
 def WeightedLeastSquares(X,Y,weights=None,verbose=False,standardize=True):
 
     """ Weighted LS, reduces to OLS when weights is None. This implementation computes
     the estimator and covariance matrix based on sample variance. For TSIR however, the
 
-    NB: x is assumed to be an array with shape = (num_data points, num_features) """
-
-    ## Get the dimensions
-    num_data_points = X.shape[0]
-    try:
-        num_features = X.shape[1]
-    except:
-        num_features = 1
-        X = X.reshape((num_data_points,1))
-
-    ## Initialize weight matrix
+    NB: x is assumed to be an array with shape = (num_data points, num_features), and weights
+    is a vector with one entry per data point. The weighted problem is solved as ordinary least
+    squares on the rows scaled by sqrt(weights), so no (num_data_points x num_data_points)
+    matrix is ever formed.
+
+    A stack of independent problems (i.e. many countries or many candidate SIA efficacies)
+    can be solved in one call by passing X with shape (num_problems, num_data_points,
+    num_features) and Y with shape (num_problems, num_data_points). Weights can be shared,
+    with shape (num_data_points,), or given per problem, and the outputs gain a leading
+    num_problems axis. """
+
+    ## Promote everything to a stack of problems
+    X = np.asarray(X,dtype=np.float64)
+    Y = np.asarray(Y,dtype=np.float64)
+    batched = (X.ndim == 3)
+    if not batched:
+        y_shape = Y.shape
+        X = X.reshape((1,X.shape[0],-1))
+    num_problems, num_data_points, num_features = X.shape
+    Y = Y.reshape((num_problems,num_data_points))
+
+    ## Square root weights for the row scaling
     if weights is None:
-        W = np.eye(num_data_points)
+        sqrt_w = np.ones((1,num_data_points))
     else:
-        W = np.diag(weights)
+        sqrt_w = np.sqrt(np.asarray(weights,dtype=np.float64)).reshape((-1,num_data_points))
 
     ## Standardize the inputs and outputs to help with
     ## stability of the matrix inversion. This is needed because
     ## cumulative cases and births both get very large.
     if standardize:
-        muY = Y.mean()
-        sigY = Y.std()
-        muX = X.mean(axis=0)
-        sigX = X.std(axis=0)
-        X = (X-muX)/sigX
-        Y = (Y-muY)/sigY
+        muY = Y.mean(axis=1)
+        sigY = Y.std(axis=1)
+        muX = X.mean(axis=1)
+        sigX = X.std(axis=1)
+        X = (X-muX[:,None,:])/sigX[:,None,:]
+        Y = (Y-muY[:,None])/sigY[:,None]
 
     ## Compute the required matrix inversion
     ## i.e. inv(x.T*w*x), which comes from minimizing
     ## the residual sum of squares (RSS) and solving for
-    ## the optimum coefficients. See eq. 3.6 in EST
-    xTwx_inv = np.linalg.inv(np.dot(X.T,np.dot(W,X)))
+    ## the optimum coefficients. See eq. 3.6 in EST. With the rows
+    ## scaled, x.T*w*x = xs.T*xs, which we factor with Cholesky.
+    Xs = sqrt_w[:,:,None]*X
+    XsT = np.swapaxes(Xs,1,2)
+    xTwx = np.matmul(XsT,Xs)
+
+    ## Problems with non-finite data (i.e. log of a negative I_t) get NaN
+    ## estimates, so they can't break the factorization for the rest of a batch.
+    finite = np.isfinite(xTwx).all(axis=(1,2))
+    xTwx[~finite] = np.eye(num_features)
+    L_inv = np.linalg.inv(np.linalg.cholesky(xTwx))
+    xTwx_inv = np.matmul(np.swapaxes(L_inv,1,2),L_inv)
+    xTwx_inv[~finite] = np.nan
 
     ## Now use that matrix to compute the optimum coefficients
     ## and their uncertainty.
-    beta_hat = np.dot(xTwx_inv,np.dot(X.T,np.dot(W,Y)))
+    beta_hat = np.matmul(xTwx_inv,np.matmul(XsT,(sqrt_w*Y)[:,:,None]))[:,:,0]
 
     ## Compute the estimated variance in the data points
-    residual = Y - np.dot(X,beta_hat)
+    residual = Y - np.matmul(X,beta_hat[:,:,None])[:,:,0]
     RSS = (residual)**2
-    var = RSS.sum(axis=0)/(num_data_points - num_features)
+    var = RSS.sum(axis=1)/(num_data_points - num_features)
 
     ## Then the uncertainty (covariance matrix) is simply a 
     ## reapplication of the inv(x.T*x):
-    beta_var = var*xTwx_inv
-
-    ## Reshape the outputs
-    beta_hat = beta_hat.reshape((num_features,))
+    beta_var = var[:,None,None]*xTwx_inv
 
     ## Rescale back to old values
     if standardize:
-        X = sigX*X + muX
-        Y = sigY*Y + muY
-        beta_hat = beta_hat*(sigY/sigX)
-        sig = np.diag(sigY/sigX)
-        beta_var = np.dot(sig,np.dot(beta_var,sig))
-        residual = sigY*residual + muY - np.dot(muX,beta_hat)
+        scale = sigY[:,None]/sigX
+        beta_hat = beta_hat*scale
+        beta_var = scale[:,:,None]*beta_var*scale[:,None,:]
+        residual = sigY[:,None]*residual + muY[:,None] - (muX*beta_hat).sum(axis=1)[:,None]
+
+    ## Reshape the outputs
+    if not batched:
+        beta_hat = beta_hat[0]
+        beta_var = beta_var[0]
+        residual = residual[0].reshape(y_shape)
 
     ## Print summary if needed
-    if verbose:
+    if verbose and not batched:
         for i in range(num_features):
             output = (i,beta_hat[i],2.*np.sqrt(beta_var[i,i]))
             print("Feature %i: coeff = %.4f +/- %.3f." % output)
@@ -123,37 +171,25 @@ def BasicSusceptibleReconstruction(df,sia,rep_rate_uq=False):
 
         return reporting_rate, Z_t, I_t
 
-    ## Construct the SIA matrix, a (t x t) matrix
-    ## with 1-sia coverage cumulative products as entries.
-    n_steps = len(df)
-    M_sia = np.zeros((n_steps-1,n_steps-1))
+    ## The SIA adjustments are products with a (t x t) matrix, A, of
+    ## 1-sia coverage cumulative products (see the notes for details). The
+    ## intercept's matrix, D, is A with its first column zeroed, which doesn't
+    ## matter since x1 starts at zero. Products with A are a first order
+    ## recurrence in the coverage, so we compute them with sia_adjusted_cumsum
+    ## instead of forming the matrices.
     sia_c = 1. - sia.values
-    for i in range(n_steps-1):
-        M_sia[i:,i] = np.cumprod(sia_c[i:-1])
-
-    ## Now construct the adjustment matrices.   
-    ## D (for the intercept) and A (for the births and cases)
-    ## For D, we need a column of zeros and then the sia block.
-    D = np.zeros((n_steps,n_steps))
-    D[1:,1:] = M_sia
-
-    ## A has a repeated M_sia column as the first column, 
-    ## with a 1 in the extra entry. (See the notes for details).
-    A = np.eye(n_steps)
-    A[1:,0] = M_sia[:,0]
-    A[1:,1:] = M_sia
 
     ## Now we create the output vector
-    output = np.dot(A,df["adj_births"].values+1.)
+    output = sia_adjusted_cumsum(df["adj_births"].values+1.,sia_c)
 
     ## And the feature matrix. x0 is the sia-adjusted cumulative cases,
     ## which corresponds to the reporting rate and x1
     ## corresponds to the intercept (which is identifiable only due to
     ## sia's).
-    x0 = np.dot(A,(df["cases"].values+1.).reshape(-1,1))
-    x1 = np.zeros((n_steps,1)) 
-    x1[1:,0] = sia.values[:-1]/sia_c[:-1]
-    x1 = np.dot(D,x1)
+    x0 = sia_adjusted_cumsum(df["cases"].values+1.,sia_c).reshape(-1,1)
+    x1 = np.zeros((len(df),))
+    x1[1:] = sia.values[:-1]/sia_c[:-1]
+    x1 = sia_adjusted_cumsum(x1,sia_c).reshape(-1,1)
 
     ## Since we're using the detrended method, S_t = S_bar + Z_t where
     ## S_bar is a constant.
@@ -245,17 +281,8 @@ def LongTermR2Score(theta,df,
     transmission_model = transmission_regression_function(df,Z_t,I_t)
 
     ## Compute the skeleton and inferred I
-    skeleton = np.zeros((len(df),))
-    skeleton[0] = I_t[0]
-    S_skeleton = np.zeros((len(df),))
-    S_skeleton[0] = transmission_model["S_bar"] + Z_t[0]
-
-    ## Loop over time and compute the skeleton
-    for i in range(1,len(df)):
-        time_in_period = i % transmission_model["periodicity"]
-        skeleton[i] = transmission_model["scale_factor"]*transmission_model["t_beta"][time_in_period]*\
-                      (S_skeleton[i-1])*(skeleton[i-1]**transmission_model["alpha"])
-        S_skeleton[i] = (S_skeleton[i-1] + df["adj_births"].values[i] - skeleton[i])*(1.-sia.values[i-1])
+    skeleton = TSIRSkeleton(transmission_model,Z_t,I_t,
+                            df["adj_births"].values,sia.values)
 
     ## Compute R2 score
     if mse:
@@ -263,20 +290,349 @@ def LongTermR2Score(theta,df,
     else:
         return r2_score(I_t[cutoff:],skeleton[cutoff:])
 
+def TSIRSkeleton(transmission_model,Z_t,I_t,adj_births,sia):
+
+    """ The deterministic TSIR skeleton, started from the inferred I_t and S_bar + Z_t. For
+    a batch, Z_t, I_t, and sia have shape (k, len(df)) and the transmission model's entries
+    carry a leading k axis (as from BatchedBasicTransmissionRegression), and all k skeletons
+    are advanced together. """
+
+    ## Promote to a batch of 1 if needed
+    batched = (np.ndim(I_t) == 2)
+    I_t, Z_t, sia = [np.atleast_2d(a) for a in (I_t,Z_t,sia)]
+    expand = lambda x: np.asarray(x).reshape((I_t.shape[0],-1))
+    scale_factor = expand(transmission_model["scale_factor"]*np.ones((I_t.shape[0],)))[:,0]
+    t_beta = expand(transmission_model["t_beta"])
+    alpha = expand(transmission_model["alpha"])[:,0]
+    S_bar = expand(transmission_model["S_bar"])[:,0]
+    periodicity = transmission_model["periodicity"]
+    sia_c = 1.-sia
+
+    ## Set up the initial conditions
+    skeleton = np.zeros(I_t.shape)
+    skeleton[:,0] = I_t[:,0]
+    S_skeleton = np.zeros(I_t.shape)
+    S_skeleton[:,0] = S_bar + Z_t[:,0]
+
+    ## Loop over time and compute the skeleton
+    for i in range(1,I_t.shape[1]):
+        time_in_period = i % periodicity
+        skeleton[:,i] = scale_factor*t_beta[:,time_in_period]*\
+                        (S_skeleton[:,i-1])*(skeleton[:,i-1]**alpha)
+        S_skeleton[:,i] = (S_skeleton[:,i-1] + adj_births[i] - skeleton[:,i])*sia_c[:,i-1]
+
+    if not batched:
+        return skeleton[0]
+    return skeleton
+
+def SIAMatrix(thetas,df):
+
+    """ The (k, len(df)) SIA columns for a (k, num_sias) matrix of candidate SIA efficacies,
+    set on the non-zero entries of df's target population column. """
+
+    target_pop = df["target_pop"].values
+    sia = np.zeros((len(thetas),len(df)))
+    sia[:,target_pop != 0.] = thetas*target_pop[target_pop != 0.]
+    return sia
+
+def BatchedBasicSusceptibleReconstruction(df,sia):
+
+    """ BasicSusceptibleReconstruction for k candidate SIA columns at once, with sia a
+    (k, len(df)) array. The sia-adjusted sums are computed together and the k regressions
+    are solved as one stacked least squares problem. Returns the reporting rates, shape
+    (k,), and Z_t and I_t, shape (k, len(df)). Candidates without any SIAs use the
+    basic (no SIA) method, as in BasicSusceptibleReconstruction. """
+
+    ## Allocate space
+    k, n_steps = sia.shape
+    reporting_rate = np.zeros((k,))
+    Z_t = np.zeros((k,n_steps))
+    I_t = np.zeros((k,n_steps))
+    cases = df["cases"].values+1.
+
+    ## Candidates without SIAs, one at a time
+    has_sia = (sia != 0).any(axis=1)
+    for i in np.flatnonzero(~has_sia):
+        reporting_rate[i], Z_t[i], I_t[i] = BasicSusceptibleReconstruction(df,
+                                                pd.Series(sia[i],index=df.index))
+    if not has_sia.any():
+        return reporting_rate, Z_t, I_t
+
+    ## And the rest together, with time on the first axis
+    ## for the sia-adjusted sums.
+    sia_t = sia[has_sia].T
+    sia_c = 1.-sia_t
+    output = sia_adjusted_cumsum((df["adj_births"].values+1.)[:,None],sia_c)
+    x0 = sia_adjusted_cumsum(cases[:,None],sia_c)
+    x1 = np.zeros(sia_c.shape)
+    x1[1:] = sia_t[:-1]/sia_c[:-1]
+    x1 = sia_adjusted_cumsum(x1,sia_c)
+    features = np.stack([x0.T,x1.T],axis=2)
+
+    ## Compute the MLEs, with the same weights for every candidate
+    weights = 1./np.sqrt(cases)
+    beta, beta_var, residual = WeightedLeastSquares(features,output.T,weights)
+
+    ## Compute high level results
+    reporting_rate[has_sia] = 1./beta[:,0]
+    Z_t[has_sia] = residual
+    I_t[has_sia] = beta[:,0,None]*cases[None,:]-1.
+
+    return reporting_rate, Z_t, I_t
+
+def BatchedBasicTransmissionRegression(df,Z_t,I_t,periodicity=24):
+
+    """ BasicTransmissionRegression for k candidates at once, with Z_t and I_t of shape
+    (k, len(df)). The entries of the output dictionary carry a leading k axis. """
+
+    ## Set up the stacked feature matrices and response vectors, (k,N,p) and (k,N),
+    ## sharing the seasonal indicator columns.
+    k = I_t.shape[0]
+    N = len(df)-1
+    p = periodicity+2
+    X = np.zeros((k,N,p))
+    with np.errstate(invalid="ignore",divide="ignore"):
+        log_I = np.log(I_t)
+    Y = log_I[:,1:]
+    X[:,:,:periodicity] = np.vstack((int(N/periodicity)+1)*[np.eye(periodicity)])[1:N+1]
+    X[:,:,periodicity] = log_I[:,:-1]
+    X[:,:,periodicity+1] = Z_t[:,:-1]
+
+    ## Compute the regressions
+    params, params_var, residual = WeightedLeastSquares(X,Y,standardize=False)
+
+    ## Compute the sample variance
+    RSS = (residual)**2
+    var = RSS.sum(axis=1)/(N-p)
+
+    ## Compute the standard error in the betas via taylor series
+    S_bar = 1./params[:,periodicity+1]
+    sig2s = np.diagonal(params_var,axis1=1,axis2=2)
+    sig2 = sig2s[:,:periodicity] + sig2s[:,periodicity+1,None]/(S_bar[:,None]**2)
+    t_sig = np.exp(params[:,:periodicity])*np.sqrt(sig2)/S_bar[:,None]
+
+    ## Collect the same quantities as BasicTransmissionRegression
+    transmission_model = {"params":params,
+                          "params_var":params_var,
+                          "S_bar":S_bar,
+                          "S_bar_std":np.sqrt(sig2s[:,periodicity+1])/(params[:,periodicity+1]**2),
+                          "t_beta":np.exp(params[:,:periodicity])*params[:,periodicity+1,None],
+                          "t_beta_sig":t_sig,
+                          "alpha":params[:,periodicity],
+                          "alpha_std":np.sqrt(sig2s[:,periodicity]),
+                          "std_logE":np.sqrt(var),
+                          "scale_factor":np.ones((k,)),
+                          "periodicity":periodicity}
+
+    return transmission_model
+
+def BatchedLongTermR2Score(thetas,df,
+                           susceptible_reconstruction_function=BatchedBasicSusceptibleReconstruction,
+                           transmission_regression_function=BatchedBasicTransmissionRegression,
+                           mse=False,cutoff=0):
+
+    """ LongTermR2Score for a (k, num_sias) matrix of candidate SIA efficacies, i.e. the rows
+    of a finite difference stencil, a set of starting points, or a grid. The reconstructions
+    and regressions are solved as stacked problems and the k skeletons advance through time
+    together, so this costs one pass instead of k. Returns the k R2 values (or the scaled
+    negative SSEs if mse), with NaN for candidates whose fits break down. """
+
+    ## Set up the candidate SIA columns and fit
+    thetas = np.atleast_2d(thetas)
+    sia = SIAMatrix(thetas,df)
+    reporting_rate, Z_t, I_t = susceptible_reconstruction_function(df,sia)
+    transmission_model = transmission_regression_function(df,Z_t,I_t)
+
+    ## Compute the skeletons
+    with np.errstate(invalid="ignore",over="ignore"):
+        skeleton = TSIRSkeleton(transmission_model,Z_t,I_t,
+                                df["adj_births"].values,sia)
+
+    ## Compute the scores
+    y_true = I_t[:,cutoff:]
+    sse = np.sum((y_true - skeleton[:,cutoff:])**2,axis=1)
+    if mse:
+        return -0.5*sse
+    sst = np.sum((y_true - y_true.mean(axis=1,keepdims=True))**2,axis=1)
+    return 1.-sse/sst
+
+def _sia_adjusted_cumsum_tangent(y,b,db,sia_c,dsia_c):
+
+    """ Forward mode derivatives of y = sia_adjusted_cumsum(b,sia_c), given the tangents of b
+    and sia_c with a trailing axis of directions. Differentiating the recurrence gives the
+    same recurrence, driven by db plus the change in depletion at each SIA. """
+
+    g = np.array(db,dtype=np.float64)
+    g[1:] += dsia_c[:-1]*((y[:-1]+b[1:])/sia_c[:-1])[:,None]
+    return sia_adjusted_cumsum(g,sia_c[:,None])
+
+def _least_squares_tangent(X,Y,beta,dX,dY,weights=None,center=False):
+
+    """ Forward mode derivatives of the weighted least squares estimate beta, given the
+    tangents dX (n, p, m) and dY (n, m). With center, the data are centered first, which is
+    what standardize=True in WeightedLeastSquares amounts to (the scaling cancels). """
+
+    if center:
+        X, Y = X-X.mean(axis=0), Y-Y.mean()
+        dX, dY = dX-dX.mean(axis=0), dY-dY.mean(axis=0)
+    w = np.ones((len(Y),)) if weights is None else weights
+
+    ## Differentiate the normal equations, (x.T*w*x) beta = x.T*w*y, and solve with
+    ## the columns scaled to unit size for stability.
+    residual = Y - np.dot(X,beta)
+    rhs = np.einsum("npm,n->pm",dX,w*residual) + \
+          np.dot(X.T,w[:,None]*(dY - np.einsum("npm,p->nm",dX,beta)))
+    scale = np.sqrt((X**2).mean(axis=0))
+    Xs = X/scale
+    return np.linalg.solve(np.dot(Xs.T,w[:,None]*Xs),rhs/scale[:,None])/scale[:,None]
+
+def LongTermR2ScoreGradient(theta,df,mse=False,cutoff=0,periodicity=24):
+
+    """ LongTermR2Score with the basic reconstruction and transmission regression, along with
+    its exact gradient with respect to the SIA efficacies in theta. Derivatives are carried
+    forward through the sia-adjusted sums, both regressions, and the skeleton recursion, one
+    direction per SIA, so the gradient costs about as much as a few objective evaluations
+    instead of one per SIA.
+
+    Without any SIAs in effect (i.e. theta = 0) the reconstruction switches to the basic
+    model, so there we fall back to finite differences. Returns the score and gradient. """
+
+    ## The SIA column and its derivatives with respect to
+    ## theta, one column per SIA.
+    target_pop = df["target_pop"].values
+    sia_steps = np.flatnonzero(target_pop != 0.)
+    n_steps, num_sias = len(df), len(sia_steps)
+    sia = np.zeros((n_steps,))
+    sia[sia_steps] = theta*target_pop[sia_steps]
+    if not (sia != 0).any():
+        f = lambda x: LongTermR2Score(x,df,
+                                      BasicSusceptibleReconstruction,
+                                      lambda df,Z_t,I_t: BasicTransmissionRegression(df,Z_t,I_t,periodicity),
+                                      mse=mse,cutoff=cutoff)
+        return f(theta), approx_fprime(theta,f,1.e-8)
+    dsia = np.zeros((n_steps,num_sias))
+    dsia[sia_steps,np.arange(num_sias)] = target_pop[sia_steps]
+    sia_c, dsia_c = 1.-sia, -dsia
+
+    ## Susceptible reconstruction, as in BasicSusceptibleReconstruction,
+    ## with the sia-adjusted sums and their tangents.
+    adj_births = df["adj_births"].values
+    cases = df["cases"].values+1.
+    zeros = np.zeros((n_steps,num_sias))
+    output = sia_adjusted_cumsum(adj_births+1.,sia_c)
+    d_output = _sia_adjusted_cumsum_tangent(output,adj_births+1.,zeros,sia_c,dsia_c)
+    x0 = sia_adjusted_cumsum(cases,sia_c)
+    d_x0 = _sia_adjusted_cumsum_tangent(x0,cases,zeros,sia_c,dsia_c)
+    x1_in = np.zeros((n_steps,))
+    x1_in[1:] = sia[:-1]/sia_c[:-1]
+    d_x1_in = np.zeros((n_steps,num_sias))
+    d_x1_in[1:] = dsia[:-1]/(sia_c[:-1]**2)[:,None]
+    x1 = sia_adjusted_cumsum(x1_in,sia_c)
+    d_x1 = _sia_adjusted_cumsum_tangent(x1,x1_in,d_x1_in,sia_c,dsia_c)
+
+    ## The regression, with Z_t = output - features*beta
+    features = np.stack([x0,x1],axis=1)
+    d_features = np.stack([d_x0,d_x1],axis=1)
+    weights = 1./np.sqrt(cases)
+    beta, beta_var, Z_t = WeightedLeastSquares(features,output,weights)
+    d_beta = _least_squares_tangent(features,output,beta,d_features,d_output,weights,center=True)
+    d_Z_t = d_output - np.einsum("npm,p->nm",d_features,beta) - np.dot(features,d_beta)
+    I_t = beta[0]*cases-1.
+    d_I_t = cases[:,None]*d_beta[0][None,:]
+
+    ## Transmission regression, as in BasicTransmissionRegression
+    transmission_model = BasicTransmissionRegression(df,Z_t,I_t,periodicity)
+    params = transmission_model["params"]
+    N = n_steps-1
+    X = np.zeros((N,periodicity+2))
+    X[:,:periodicity] = np.vstack((int(N/periodicity)+1)*[np.eye(periodicity)])[1:N+1]
+    X[:,periodicity] = np.log(I_t[:-1])
+    X[:,periodicity+1] = Z_t[:-1]
+    d_log_I = d_I_t/I_t[:,None]
+    dX = np.zeros((N,periodicity+2,num_sias))
+    dX[:,periodicity] = d_log_I[:-1]
+    dX[:,periodicity+1] = d_Z_t[:-1]
+    d_params = _least_squares_tangent(X,np.log(I_t[1:]),params,dX,d_log_I[1:])
+
+    ## And the derived skeleton parameters
+    scale_factor = transmission_model["scale_factor"]
+    t_beta = transmission_model["t_beta"]
+    alpha = transmission_model["alpha"]
+    d_t_beta = t_beta[:,None]*d_params[:periodicity] + \
+               np.exp(params[:periodicity])[:,None]*d_params[periodicity+1][None,:]
+    d_alpha = d_params[periodicity]
+    d_S_bar = -d_params[periodicity+1]/(params[periodicity+1]**2)
+
+    ## Loop over time and compute the skeleton and its tangents
+    skeleton = np.zeros((n_steps,))
+    S_skeleton = np.zeros((n_steps,))
+    d_skeleton = np.zeros((n_steps,num_sias))
+    d_S_skeleton = np.zeros((n_steps,num_sias))
+    skeleton[0] = I_t[0]
+    d_skeleton[0] = d_I_t[0]
+    S_skeleton[0] = transmission_model["S_bar"] + Z_t[0]
+    d_S_skeleton[0] = d_S_bar + d_Z_t[0]
+    for i in range(1,n_steps):
+        time_in_period = i % periodicity
+        power = skeleton[i-1]**alpha
+        d_power = power*d_alpha*np.log(skeleton[i-1]) + \
+                  alpha*(skeleton[i-1]**(alpha-1.))*d_skeleton[i-1]
+        skeleton[i] = scale_factor*t_beta[time_in_period]*\
+                      (S_skeleton[i-1])*(power)
+        d_skeleton[i] = scale_factor*(d_t_beta[time_in_period]*S_skeleton[i-1]*power
+                                      + t_beta[time_in_period]*d_S_skeleton[i-1]*power
+                                      + t_beta[time_in_period]*S_skeleton[i-1]*d_power)
+        S_skeleton[i] = (S_skeleton[i-1] + adj_births[i] - skeleton[i])*sia_c[i-1]
+        d_S_skeleton[i] = (d_S_skeleton[i-1] - d_skeleton[i])*sia_c[i-1] + \
+                          (S_skeleton[i-1] + adj_births[i] - skeleton[i])*dsia_c[i-1]
+
+    ## Finally the score and its gradient
+    error = I_t[cutoff:] - skeleton[cutoff:]
+    sse = np.sum(error**2)
+    d_sse = 2.*np.dot(error,d_I_t[cutoff:] - d_skeleton[cutoff:])
+    if mse:
+        return -0.5*sse, -0.5*d_sse
+    deviation = I_t[cutoff:] - I_t[cutoff:].mean()
+    sst = np.sum(deviation**2)
+    d_sst = 2.*np.dot(deviation,d_I_t[cutoff:])
+    return 1.-sse/sst, -(d_sse*sst - sse*d_sst)/(sst**2)
+
+## Objective value for SIA efficacies where the model breaks down (i.e. the
+## score isn't finite), large enough that the line search backs away from them.
+NONFINITE_PENALTY = 1.e10
+
 def FitTSIRModel(df,susceptible_reconstruction_function,transmission_regression_function,
-                 initial_guess=0.25,cutoff=0,verbose=True):
+                 initial_guess=0.25,cutoff=0,verbose=True,gradient=True):
+
+    """ Fit the SIA efficacies by maximizing the long term R2 score. With the basic
+    reconstruction and regression functions, the optimizer gets the exact gradient from
+    LongTermR2ScoreGradient, unless gradient is False. Otherwise it falls back to finite
+    differences. Whether the optimizer converged, and its message, are stored in the
+    transmission model under "success" and "message". """
 
     ## Set up the initial guess
     num_params = len(df.loc[df["target_pop"] != 0.])
     x0 = initial_guess*np.ones((num_params,))
 
     ## Use scipy.minimize on -R2Score
-    f = lambda x: -LongTermR2Score(x,df,
-                                   susceptible_reconstruction_function,
-                                   transmission_regression_function,
-                                   mse=False,cutoff=cutoff)
-    result = minimize(f,x0,method="L-BFGS-B",
-                      bounds=num_params*[(0.,0.999)])
+    if gradient and (susceptible_reconstruction_function is BasicSusceptibleReconstruction)\
+                and (transmission_regression_function is BasicTransmissionRegression):
+        def f(x):
+            score, grad = LongTermR2ScoreGradient(x,df,mse=False,cutoff=cutoff)
+            if not (np.isfinite(score) and np.isfinite(grad).all()):
+                return NONFINITE_PENALTY, np.zeros(x.shape)
+            return -score, -grad
+        result = minimize(f,x0,method="L-BFGS-B",jac=True,
+                          bounds=num_params*[(0.,0.999)])
+        if result["fun"] >= NONFINITE_PENALTY:
+            raise ValueError("The long term R2 score isn't finite at the initial guess.")
+    else:
+        f = lambda x: -LongTermR2Score(x,df,
+                                       susceptible_reconstruction_function,
+                                       transmission_regression_function,
+                                       mse=False,cutoff=cutoff)
+        result = minimize(f,x0,method="L-BFGS-B",
+                          bounds=num_params*[(0.,0.999)])
 
     ## Summarize the optimization results
     if verbose:
@@ -296,6 +652,11 @@ def FitTSIRModel(df,susceptible_reconstruction_function,transmission_regression_
     reporting_rate, Z_t, I_t = susceptible_reconstruction_function(df,sia)
     transmission_model = transmission_regression_function(df,Z_t,I_t)
 
+    ## Record whether the optimizer converged, so callers can
+    ## tell a fit from a stalled line search.
+    transmission_model["success"] = bool(result["success"])
+    transmission_model["message"] = str(result["message"])
+
     ## Store the end results
     df["sia"] = sia
     df["Z_t"] = Z_t
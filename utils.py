@@ -14,6 +14,24 @@ import matplotlib.pyplot as plt
 from matplotlib.patches import ConnectionPatch
 from mpl_toolkits.axes_grid1.inset_locator import inset_axes
 
+## Cached WHO case data
+from who_cases import read_case_table, mid_month_times
+
+def case_grid(table, rows):
+    """
+    Scatter the selected spreadsheet rows into a dense (month, country) array of cases, with
+    NaN for months without a row and a trailing row of NaNs so that month + 1 is always a
+    valid index. Returns the grid, the first year, the sorted countries, and each row's
+    (month, country) indices.
+    """
+    codes, countries = pd.factorize(table["countries"][table["code"][rows]], sort=True)
+    year = table["year"][rows]
+    first_year = year.min()
+    month = 12 * (year - first_year)[:, None] + np.arange(12)[None, :]
+    grid = np.full((12 * (year.max() - first_year + 1) + 1, len(countries)), np.nan)
+    grid[month, codes[:, None]] = np.nan_to_num(table["cases"][rows])
+    return grid, first_year, countries, month, codes[:, None]
+
 def process_case_data(
     filename,
     countries_list=["Pakistan", "Chad", "Ethiopia", "Madagascar", "Nigeria"],
@@ -22,67 +40,32 @@ def process_case_data(
     """
     Process raw WHO case data for use in seasonality profile regression.
     """
-    rawdata = pd.read_csv(filename)
-    rawdata = rawdata[
-        [
-            "Country",
-            "Year",
-            "January",
-            "February",
-            "March",
-            "April",
-            "May",
-            "June",
-            "July",
-            "August",
-            "September",
-            "October",
-            "November",
-            "December",
-        ]
-    ].fillna(0)
-    rawdata = rawdata[rawdata["Country"].isin(countries_list)]
-
-    long_format = rawdata.melt(
-        id_vars=["Country", "Year"],
-        value_vars=[
-            "January",
-            "February",
-            "March",
-            "April",
-            "May",
-            "June",
-            "July",
-            "August",
-            "September",
-            "October",
-            "November",
-            "December",
-        ],
-        var_name="Month",
-        value_name="Cases",
-    )
-
-    long_format["time"] = pd.to_datetime(
-        long_format["Month"].astype("str")
-        + " "
-        + long_format["Year"].astype("str")
-        + " 15",
-        format="%B %Y %d",
-    )
-
-    long_format["cases_next_month"] = (
-        long_format.sort_values("time")
-        .groupby("Country")["Cases"]
-        .apply(lambda x: x.shift(-1))
-    )
+    ## Parsed (and cached) spreadsheet, subset to the countries
+    ## of interest
+    table = read_case_table(filename)
+    country = table["countries"][table["code"]]
+    rows = np.isin(country, countries_list)
+    country = country[rows].astype(object)
+    cases = np.nan_to_num(table["cases"][rows])
+
+    ## Next month's cases, read off the dense (month, country) grid
+    grid, _, _, month, codes = case_grid(table, rows)
+    cases_next_month = grid[month + 1, codes]
+
+    ## Stack the month columns (month by month, as a melt would), with
+    ## dates built from the year and month indices.
+    long_format = pd.DataFrame({
+        "Country": np.tile(country, 12),
+        "Cases": cases.T.reshape(-1),
+        "time": mid_month_times(table["year"][rows]).T.reshape(-1),
+        "cases_next_month": cases_next_month.T.reshape(-1),
+        })
 
     long_format["case_ratio_adjusted"] = (
         np.sqrt((long_format["cases_next_month"]+1) /\
         (long_format["Cases"]+1))
         )
     long_format.dropna(subset=["case_ratio_adjusted"], inplace=True)
-    long_format.drop(["Month", "Year"], axis=1, inplace=True)
 
     if long_return:
         return long_format
@@ -92,6 +75,44 @@ def process_case_data(
         )
         return tr_data
 
+def process_case_array(filename, countries_list=None):
+    """
+    Wide (time by country) frames of Cases, cases_next_month, and case_ratio_adjusted, as in
+    process_case_data but computed with a single shift of a dense (month, country) array and
+    no pivots. Months without data are NaN, trailing months without a case ratio for any country
+    (i.e. the padding to the end of the last year) are trimmed, and every country in the file
+    is included if countries_list is None. The log case ratios that BatchedProfileRegression
+    takes directly are 0.5*(np.log(cases_next_month+1) - np.log(Cases+1)), which, unlike
+    np.log(case_ratio_adjusted), leaves out negative case counts. ProfileRegression takes them
+    too, but it doesn't mask missing months, so it needs countries with complete histories.
+    """
+    table = read_case_table(filename)
+    rows = np.ones(len(table["code"]), dtype=bool)
+    if countries_list is not None:
+        rows = np.isin(table["countries"][table["code"]], countries_list)
+    grid, first_year, countries, _, _ = case_grid(table, rows)
+
+    ## Shift once along the time axis
+    cases = grid[:-1]
+    cases_next_month = grid[1:]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        case_ratio_adjusted = np.sqrt((cases_next_month + 1) / (cases + 1))
+
+    ## Trim the months after the last case ratio
+    observed = np.isfinite(case_ratio_adjusted).any(axis=1)
+    end = len(observed) - np.argmax(observed[::-1]) if observed.any() else 0
+    cases = cases[:end]
+    cases_next_month = cases_next_month[:end]
+    case_ratio_adjusted = case_ratio_adjusted[:end]
+
+    ## Wrap the arrays, with mid-month time stamps
+    years = np.arange(first_year, first_year + len(grid) // 12)
+    index = pd.DatetimeIndex(mid_month_times(years).reshape(-1)[:end], name="time")
+    columns = pd.Index(countries.astype(object), name="Country")
+    return (pd.DataFrame(cases, index=index, columns=columns),
+            pd.DataFrame(cases_next_month, index=index, columns=columns),
+            pd.DataFrame(case_ratio_adjusted, index=index, columns=columns))
+
 def process_sia_calendar(filename):
     """
     Simple function to deal with date processing in the SIA calendar
@@ -112,6 +133,33 @@ def process_sia_calendar(filename):
                                     .str.replace(" ","")))
     return sia_cal
 
+def sia_dose_covariate(sia_cal, time_index, countries, scale=1.e6):
+    """
+    Monthly SIA doses (in millions by default) for every country at once, as a (time by
+    country) frame aligned with the case panel's time_index. Each campaign in sia_cal (from
+    process_sia_calendar) is counted in the month it starts, via a grouped sum over (month,
+    country) codes, so memory is linear in the number of campaigns. Months and countries
+    without campaigns are 0.
+    """
+    sia_cal = sia_cal.dropna(subset=["time", "doses"])
+    time = pd.DatetimeIndex(sia_cal["time"])
+    time_index = pd.DatetimeIndex(time_index)
+    countries = pd.Index(countries)
+
+    ## Month codes for the campaigns and the panel
+    sia_months = 12 * time.year.values + time.month.values
+    panel_months = pd.Index(12 * time_index.year.values + time_index.month.values)
+    rows = panel_months.get_indexer(sia_months)
+    cols = countries.get_indexer(sia_cal["Country"].values)
+    keep = (rows >= 0) & (cols >= 0)
+
+    ## And accumulate
+    size = len(time_index) * len(countries)
+    doses = np.bincount(rows[keep] * len(countries) + cols[keep],
+                        weights=sia_cal["doses"].values[keep],
+                        minlength=size).reshape(len(time_index), len(countries))
+    return pd.DataFrame(doses / scale, index=time_index, columns=countries)
+
 def axes_setup(axes):
     """
     Setup a matplotlib axis with custom settings.
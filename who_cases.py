@@ -0,0 +1,121 @@
+""" who_cases.py
+
+Shared ingestion of the WHO spreadsheet of measles cases by country and by month. The CSV is
+parsed once into a dense (country-year, month) array of cases and cached next to the other
+outputs in a binary .npz file, so subsequent reads skip the CSV entirely. Dates are built
+arithmetically from the year and month indices rather than by parsing strings. """
+
+import os
+import hashlib
+import tempfile
+
+## Standard imports
+import numpy as np
+import pandas as pd
+
+## The month columns, in calendar order
+MONTHS = ["January", "February", "March", "April", "May", "June", "July",
+          "August", "September", "October", "November", "December"]
+
+## Bump to invalidate existing caches when the layout changes
+CACHE_VERSION = 1
+
+def file_hash(filename, block_size=2**20):
+    """ SHA-256 of a file's contents, read in blocks. """
+    sha = hashlib.sha256()
+    with open(filename, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            sha.update(block)
+    return sha.hexdigest()
+
+def default_cache_path(filename):
+    """ The cache for data/<name>.csv lives in the outputs directory beside data, or beside the
+    source file if there isn't one. """
+    root, name = os.path.split(os.path.abspath(filename))
+    cache_dir = os.path.join(os.path.dirname(root), "outputs")
+    if not os.path.isdir(cache_dir):
+        cache_dir = root
+    return os.path.join(cache_dir, os.path.splitext(name)[0] + ".cache.npz")
+
+def parse_case_table(filename):
+    """ Parse the WHO CSV into a dictionary of arrays: the sorted unique countries, and for each
+    spreadsheet row its country code, ISO3 code, year, and the 12 monthly case counts (NaN where
+    missing), in file order. """
+    columns = ["ISO3", "Country", "Year"] + MONTHS
+    dtypes = {c: np.float64 for c in MONTHS}
+    dtypes.update({"ISO3": str, "Country": str, "Year": np.int64})
+    df = pd.read_csv(filename, usecols=columns, dtype=dtypes)
+    code, countries = pd.factorize(df["Country"], sort=True)
+    return {"countries": countries.values.astype(str),
+            "code": code,
+            "iso3": df["ISO3"].values.astype(str),
+            "year": df["Year"].values,
+            "cases": df[MONTHS].values}
+
+def read_case_table(filename, cache_path=None):
+    """ The parsed WHO spreadsheet (see parse_case_table), from the cache if it's current. The
+    cache is reused if the source's size and modification time are unchanged, and otherwise if
+    its contents hash the same, in which case the stored stat is refreshed. Anything else
+    triggers a re-parse. """
+
+    if cache_path is None:
+        cache_path = default_cache_path(filename)
+    stat = os.stat(filename)
+    key = np.array([CACHE_VERSION, stat.st_size, stat.st_mtime_ns], dtype=np.int64)
+
+    ## Try the cache
+    sha = None
+    if os.path.exists(cache_path):
+        try:
+            with np.load(cache_path) as cache:
+                table = {k: cache[k] for k in cache.files}
+        except (OSError, ValueError, KeyError):
+            table = {}
+        if "key" in table and table["key"][0] == CACHE_VERSION:
+            if (table["key"] == key).all():
+                return _strip(table)
+            sha = file_hash(filename)
+            if str(table["sha"]) == sha:
+                table["key"] = key
+                _write_cache(cache_path, table)
+                return _strip(table)
+
+    ## Otherwise parse and store
+    table = parse_case_table(filename)
+    table["key"] = key
+    table["sha"] = np.array(sha if sha is not None else file_hash(filename))
+    _write_cache(cache_path, table)
+    return _strip(table)
+
+def _strip(table):
+    """ Drop the cache bookkeeping. """
+    return {k: v for k, v in table.items() if k not in ("key", "sha")}
+
+def _write_cache(cache_path, table):
+    """ Write atomically, so an interrupted write can't leave a corrupt cache behind. Each
+    writer gets its own temporary file in the cache's directory, so processes refreshing the
+    cache at the same time can't publish each other's partial writes. """
+    with tempfile.NamedTemporaryFile(dir=os.path.dirname(os.path.abspath(cache_path)),
+                                     suffix=".tmp.npz", delete=False) as f:
+        tmp = f.name
+        try:
+            np.savez(f, **table)
+        except BaseException:
+            f.close()
+            os.remove(tmp)
+            raise
+    os.replace(tmp, cache_path)
+
+def month_index(year):
+    """ Months since January 1970 for each (row, month), shape (len(year), 12). """
+    return 12 * (np.asarray(year)[:, None] - 1970) + np.arange(12)[None, :]
+
+def mid_month_times(year, day=15):
+    """ Time stamps on the given day of each month, shape (len(year), 12), as datetime64[ns]. """
+    months = month_index(year).astype("datetime64[M]")
+    return (months.astype("datetime64[D]") + (day - 1)).astype("datetime64[ns]")
+
+def month_end_times(year):
+    """ Time stamps on the last day of each month, shape (len(year), 12), as datetime64[ns]. """
+    months = (month_index(year) + 1).astype("datetime64[M]")
+    return (months.astype("datetime64[D]") - 1).astype("datetime64[ns]")